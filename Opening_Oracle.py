@@ -1,21 +1,794 @@
+import array
+import ast
+import asyncio
+import bisect
+import bz2
 import concurrent.futures
+import contextlib
+import cProfile
 import datetime
+import gzip
+import hashlib
+import heapq
 import io
 import json
+import math
+import mmap
+import multiprocessing
 import os
-import random
+import pstats
+import queue
+import re
+import shutil
+import struct
+import sys
 import time
 import traceback
+from collections import OrderedDict
 from decimal import Decimal
-from threading import Lock
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Lock, Thread
+from urllib.parse import parse_qs, urlparse
 
 import chess
+import chess.engine
 import chess.pgn
+import chess.polyglot
 import cloudscraper
 import requests
 from bs4 import BeautifulSoup
 
-lo = Lock()
+try:
+    import aiohttp
+except ImportError:  # Only needed for download_games_async.
+    aiohttp = None
+
+try:
+    import zstandard
+except ImportError:  # Only needed to ingest .zst dumps.
+    zstandard = None
+
+# Binary store layout: header, then sorted uint64 keys, uint32 games and uint32 half-points.
+STORE_MAGIC = b'OOPS'
+STORE_VERSION = 1
+STORE_HEADER = struct.Struct('<4sIQ')
+
+# Counts for the memory budgeted analyzer: games in the low 32 bits and half-points above, so
+# each position is one int. About 100 bytes per position in a dict, int key included.
+PACKED_RESULT = {0: 1, 0.5: 1 + (1 << 32), 1: 1 + (2 << 32)}
+COUNTER_ENTRY_BYTES = 100
+
+# Move corpus (.mvs): header, then one fixed size record per game. A move is its target square
+# times 4 plus which of move_sources it comes from (see encode_move), so decoding it is a few
+# bitboard operations instead of generating moves. A game with a move that doesn't fit (a promotion,
+# or a 5th piece that could go to the same square) has them all as their index in
+# sorted_legal_moves instead, and by_index set. 255 after the last one. Result is 0 (0-1),
+# 1 (1/2-1/2) or 2 (1-0).
+MOVES_MAGIC = b'OOMV'
+MOVES_VERSION = 2
+MOVES_HEADER = struct.Struct('<4sII')  # Magic, version, record size.
+MOVE_RECORD = struct.Struct('<16sBBBBHxx')  # Moves, plies, result, time control, by_index, elo band.
+MOVE_RECORD_PLIES = 16  # keep_only_opening keeps 8 moves each.
+MOVE_TIME_TYPES = ['', 'bullet', 'blitz', 'rapid']  # 0 is a game without a bucket.
+MOVE_RESULTS = {'0-1': 0, '1/2-1/2': 1, '1-0': 2}
+MOVE_WINNERS = [(0, 1), (0.5, 0.5), (1, 0)]  # For white and black, by result.
+
+# Total seconds (base + increment * 60) for each game type.
+TIME_CONTROLS = {'bullet': (0, 180), 'blitz': (180, 600), 'rapid': (600, 3600)}
+
+# Comments like {[%clk 0:02:59.9]}. An unclosed one runs to the end of the line.
+COMMENT_RE = re.compile(r'\{[^}]*(?:\}|$)')
+# Black's move numbers (e.g. '1...'), with or without a space before the move.
+BLACK_MOVE_NUM_RE = re.compile(r'\d+\.\.\.')
+# Move annotations like 'b5?' or 'Bb3?!' (lichess) and NAGs like '$1', which aren't part of the san.
+ANNOTATION_RE = re.compile(r'[?!]+|\$\d+')
+
+zobrist_hasher = chess.polyglot.ZobristHasher(chess.polyglot.POLYGLOT_RANDOM_ARRAY)
+
+
+def position_hash(board_fen):
+    # Only the piece placement is hashed, just like the board_fen keys in the jsons.
+    return zobrist_hasher.hash_board(chess.BaseBoard(board_fen))
+
+
+def write_json_atomic(file_path, data, indent=None):
+    # A crash while writing leaves the old file instead of half of the new one.
+    with open(file_path + '.tmp', 'w') as f:
+        json.dump(data, f, indent=indent, default=str)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(file_path + '.tmp', file_path)
+
+
+def write_binary_store(file_path, fen_store, extra=None):
+    # extra is key -> [games, half points] for positions there's no fen for.
+    entries = dict(extra or {})
+    for fen, stats in fen_store.items():
+        key = position_hash(fen)
+        # Two fens with the same 64 bit hash are very unlikely, but just add them together.
+        games, half_points = entries.get(key, (0, 0))
+        entries[key] = (games + int(stats[0]), half_points + int(round(float(stats[1]) * 2)))
+
+    sorted_keys = sorted(entries)
+    keys = array.array('Q', sorted_keys)
+    games = array.array('I', [entries[key][0] for key in sorted_keys])
+    half_points = array.array('I', [entries[key][1] for key in sorted_keys])
+    write_binary_arrays(file_path, keys, games, half_points)
+
+
+def write_run(file_path, counts):
+    # A sorted run is a binary store that still has every position. counts is key -> packed int.
+    sorted_keys = sorted(counts)
+    keys = array.array('Q', sorted_keys)
+    games = array.array('I', [counts[key] & 0xFFFFFFFF for key in sorted_keys])
+    half_points = array.array('I', [counts[key] >> 32 for key in sorted_keys])
+    write_binary_arrays(file_path, keys, games, half_points)
+
+
+def iter_binary_store(file_path):
+    store = PositionStore(file_path)
+    return zip(store.keys, store.games, store.half_points)
+
+
+def merge_runs(run_paths, file_path, min_games=3):
+    # k-way merge of sorted runs into one binary store. Positions with fewer than min_games
+    # are dropped here, once every run has been added up.
+    keys = array.array('Q')
+    games = array.array('I')
+    half_points = array.array('I')
+    last_key = None
+    for key, run_games, run_half_points in heapq.merge(*[iter_binary_store(run_path) for run_path in run_paths]):
+        if key == last_key:
+            games[-1] += run_games
+            half_points[-1] += run_half_points
+            continue
+        if last_key is not None and games[-1] < min_games:
+            keys.pop()
+            games.pop()
+            half_points.pop()
+        keys.append(key)
+        games.append(run_games)
+        half_points.append(run_half_points)
+        last_key = key
+    if last_key is not None and games[-1] < min_games:
+        keys.pop()
+        games.pop()
+        half_points.pop()
+
+    write_binary_arrays(file_path, keys, games, half_points)
+
+
+def write_binary_arrays(file_path, keys, games, half_points):
+    # Write next to it and rename so processes that have the old one mapped aren't affected.
+    with open(file_path + '.tmp', 'wb') as f:
+        f.write(STORE_HEADER.pack(STORE_MAGIC, STORE_VERSION, len(keys)))
+        keys.tofile(f)
+        games.tofile(f)
+        half_points.tofile(f)
+    os.replace(file_path + '.tmp', file_path)
+
+
+def sorted_legal_moves(board):
+    # Doesn't depend on the order python-chess happens to generate them in.
+    return sorted(board.legal_moves, key=lambda move: (move.from_square, move.to_square, move.promotion or 0))
+
+
+def move_sources(board, target):
+    # Every square a move to target could come from, lowest first. Some can't really go there, but
+    # the one that moved is always in it.
+    own = board.occupied_co[board.turn]
+    target_mask = chess.BB_SQUARES[target]
+    if own & target_mask:  # Castling is king takes rook.
+        return [board.king(board.turn)]
+    attackers = board.attackers_mask(board.turn, target)
+    # Pawns push one or two squares, and only take a piece or en passant.
+    shift = chess.shift_down if board.turn == chess.WHITE else chess.shift_up
+    pawns = shift(target_mask) | shift(shift(target_mask))
+    if board.occupied_co[not board.turn] & target_mask or target == board.ep_square:
+        pawns |= attackers
+    return list(chess.scan_forward(attackers & ~board.pawns | own & board.pawns & pawns))
+
+
+def encode_move(board, move):
+    # Move corpus code of a legal move, or None if it doesn't fit in one.
+    target = move.to_square
+    if board.is_castling(move):
+        target = chess.square(7 if chess.square_file(move.to_square) > 4 else 0, chess.square_rank(move.to_square))
+    source = move_sources(board, target).index(move.from_square)
+    if move.promotion or source > 3:
+        return None
+    return target << 2 | source
+
+
+def decode_move(board, code):
+    target = code >> 2
+    from_square = move_sources(board, target)[code & 3]
+    if board.occupied_co[board.turn] & chess.BB_SQUARES[target]:  # Only the king takes its own rook.
+        return chess.Move(from_square, chess.square(6 if chess.square_file(target) == 7 else 2,
+                                                    chess.square_rank(target)))
+    return chess.Move(from_square, target)
+
+
+class PositionStore(object):
+    # Read-only view of a binary store. Looks like the json dict to SearchOpenings.
+    def __init__(self, file_path):
+        self.file_path = file_path
+        with open(file_path, 'rb') as f:
+            # The mapping stays valid after the file is closed and is shared between processes.
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, version, count = STORE_HEADER.unpack_from(self.mm)
+        if magic != STORE_MAGIC or version != STORE_VERSION:
+            raise ValueError("Not a position store: " + file_path)
+
+        view = memoryview(self.mm)
+        start = STORE_HEADER.size
+        self.keys = view[start:start + 8 * count].cast('Q')
+        start += 8 * count
+        self.games = view[start:start + 4 * count].cast('I')
+        start += 4 * count
+        self.half_points = view[start:start + 4 * count].cast('I')
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __getitem__(self, fen):
+        return self.get_by_hash(position_hash(fen))
+
+    def __contains__(self, fen):
+        try:
+            self[fen]
+            return True
+        except KeyError:
+            return False
+
+    def get_by_hash(self, key):
+        i = bisect.bisect_left(self.keys, key)
+        if i == len(self.keys) or self.keys[i] != key:
+            raise KeyError(key)
+
+        return [self.games[i], self.half_points[i] / 2]
+
+
+class MergedStore(object):
+    # Adds up the same position over several stores (e.g. elo buckets) at lookup time.
+    def __init__(self, stores, min_games=3):
+        self.stores = stores
+        self.min_games = min_games
+
+    def __getitem__(self, fen):
+        return self.get_by_hash(position_hash(fen), fen)
+
+    def get_by_hash(self, key, fen):
+        # fen is only for the stores that are still jsons.
+        games = 0
+        wins = 0
+        for store in self.stores:
+            try:
+                if isinstance(store, PositionStore):  # Only hash once for all of them.
+                    stats = store.get_by_hash(key)
+                else:
+                    stats = store[fen]
+            except KeyError:
+                continue
+            games += stats[0]
+            wins += stats[1]
+
+        # Buckets aren't pruned, so it's done here like remove_extra_stuff would.
+        if games < self.min_games:
+            raise KeyError(fen)
+        return [games, wins]
+
+    def __contains__(self, fen):
+        try:
+            self[fen]
+            return True
+        except KeyError:
+            return False
+
+
+class ArchiveCache(object):
+    # Raw monthly archives from api.chess.com, gzipped on disk with the headers needed to revalidate them.
+    def __init__(self, path_cache):
+        self.path_cache = path_cache
+
+    def paths(self, user, year, month):
+        base = os.path.join(self.path_cache, user, year + '-' + month)
+        return base + '.pgn.gz', base + '.json'
+
+    def load(self, user, year, month):
+        archive_path, meta_path = self.paths(user, year, month)
+        try:
+            with open(meta_path, 'r') as f:
+                meta = json.load(f)
+            with gzip.open(archive_path, 'rb') as f:
+                return f.read(), meta
+        except (FileNotFoundError, ValueError, OSError):
+            return None, None
+
+    def is_final(self, meta, year, month):
+        # Only once the month was over when we downloaded it can it never change again.
+        if int(month) == 12:
+            month_end = datetime.datetime(int(year) + 1, 1, 1)
+        else:
+            month_end = datetime.datetime(int(year), int(month) + 1, 1)
+        return datetime.datetime.fromisoformat(meta['fetched']) >= month_end
+
+    def conditional_headers(self, meta):
+        headers = {}
+        if meta is None:
+            return headers
+        if meta.get('etag'):
+            headers['If-None-Match'] = meta['etag']
+        if meta.get('last_modified'):
+            headers['If-Modified-Since'] = meta['last_modified']
+        return headers
+
+    def open_archive(self, user, year, month):
+        archive_path, meta_path = self.paths(user, year, month)
+        os.makedirs(os.path.dirname(archive_path), exist_ok=True)
+        return gzip.open(archive_path + '.tmp', 'wb')
+
+    def discard(self, user, year, month):
+        # A download that broke off halfway.
+        archive_path, meta_path = self.paths(user, year, month)
+        if os.path.exists(archive_path + '.tmp'):
+            os.remove(archive_path + '.tmp')
+
+    def save(self, user, year, month, response_headers, raw=None):
+        # Either the raw archive is given, or it was already written through open_archive.
+        archive_path, meta_path = self.paths(user, year, month)
+        if raw is not None:
+            with self.open_archive(user, year, month) as f:
+                f.write(raw)
+        os.replace(archive_path + '.tmp', archive_path)
+        self.save_meta(user, year, month, response_headers)
+
+    def save_meta(self, user, year, month, response_headers, meta=None):
+        # A 304 doesn't have to repeat the validators, so keep the old ones.
+        if meta is None:
+            meta = {}
+        archive_path, meta_path = self.paths(user, year, month)
+        write_json_atomic(meta_path, {
+            'etag': response_headers.get('ETag', meta.get('etag')),
+            'last_modified': response_headers.get('Last-Modified', meta.get('last_modified')),
+            'fetched': datetime.datetime.utcnow().isoformat()})
+
+
+class PGNWriter(Thread):
+    # The only thing that writes all_pgns.pgn. Download threads just queue their stripped pgns.
+    # dedup is the file's GameDeduplicator. The keys of a batch are committed once it's written
+    # and it's saved every save_every batches, so a crash only loses what came after that.
+    def __init__(self, file_path, max_queued=1000, flush_every=1000, dedup=None, save_every=10000):
+        super().__init__(daemon=True)
+        self.file_path = file_path
+        self.pgn_queue = queue.Queue(maxsize=max_queued)
+        self.flush_every = flush_every
+        self.dedup = dedup
+        self.save_every = save_every
+        self.error = None
+
+        # Opened here, so a bad path fails in the caller instead of killing the thread.
+        if self.file_path.endswith('.gz'):
+            self.pgn_file = gzip.open(self.file_path, 'at')
+        else:
+            self.pgn_file = open(self.file_path, 'a', buffering=1 << 20)
+        if self.dedup is not None:
+            # Not clean until the last save in run(), so a crash before any other save shows too.
+            self.dedup.save(self.file_path)
+
+    def write(self, user_pgn, new_keys=None):
+        if self.error is not None:
+            raise self.error
+        self.pgn_queue.put((user_pgn, new_keys))  # Waits if the writer is behind, so memory stays bounded.
+
+    def close(self):
+        self.pgn_queue.put(None)
+        self.join()
+        if self.error is not None:
+            raise self.error
+
+    def run(self):
+        since_flush = 0
+        batches = 0
+        while True:
+            item = self.pgn_queue.get()
+            if item is None:
+                break
+            if self.error is not None:
+                continue  # Still takes everything off the queue, so nothing waits on it forever.
+
+            user_pgn, new_keys = item
+            try:
+                if user_pgn != '':
+                    # Exactly one newline after every game.
+                    self.pgn_file.write(user_pgn + '\n')
+                    since_flush += 1
+                    if since_flush >= self.flush_every:
+                        self.pgn_file.flush()
+                        since_flush = 0
+
+                if self.dedup is not None:
+                    if new_keys:
+                        self.dedup.commit(new_keys)
+                    batches += 1
+                    if batches % self.save_every == 0:
+                        self.pgn_file.flush()  # So the size saved with the keys has their games.
+                        self.dedup.save(self.file_path)
+            except OSError as error:
+                self.error = error
+
+        try:
+            self.pgn_file.close()
+            if self.error is None and self.dedup is not None:
+                self.dedup.save(self.file_path, clean=True)
+        except OSError as error:
+            if self.error is None:
+                self.error = error
+
+
+class GameDeduplicator(object):
+    # Remembers the games that were kept, so one that's in both players' archives only counts once.
+    # A Bloom filter answers almost every lookup. Only when it says maybe are the exact keys looked
+    # at: the newest ones in a set, the rest in sorted runs on disk, so memory stays the same however
+    # many games there are. Keys are 64 bit hashes. path_dedup None keeps everything in memory.
+    # Each one goes with one pgn file. With deferred, a game's key is only remembered for good once
+    # commit() gets it after the game is written, so what's saved always matches the file.
+    def __init__(self, path_dedup, capacity=10000000, error_rate=0.01, max_in_memory=500000, max_runs=8,
+                 deferred=False):
+        self.path_dedup = path_dedup
+        # About 1.2 MB per million games at 1%.
+        self.num_bits = max(int(-capacity * math.log(error_rate) / math.log(2) ** 2), 64)
+        self.num_hashes = max(int(round(self.num_bits / capacity * math.log(2))), 1)
+        self.bits = bytearray((self.num_bits + 7) // 8)
+        self.keys = set()
+        self.max_in_memory = max_in_memory
+        self.max_runs = max_runs
+        self.runs = []  # (file name, sorted keys)
+        self.next_run = 0  # Never reused, so a merged run doesn't overwrite one that's still there.
+        self.stale_runs = []  # Merged away, but still in the last saved manifest.
+        self.recent_name = None  # What self.keys was at the last save.
+        self.deferred = deferred
+        self.pending = set()  # Kept by a stripper, but not written yet.
+        self.games = 0
+        self.duplicates = 0
+        self.lock = Lock()  # Download threads strip at the same time.
+
+    def seen(self, game_key, new_keys=None):
+        # True if the game was already seen. Otherwise it's remembered and its key goes in new_keys.
+        key = sketch_key(game_key)
+        with self.lock:
+            self.games += 1
+            if key in self.pending or all(self.bits[bit >> 3] & (1 << (bit & 7)) for bit in self.bit_positions(key)) \
+                    and self.is_known(key):
+                self.duplicates += 1
+                return True
+
+            if self.deferred:
+                self.pending.add(key)
+            else:
+                self.remember(key)
+            if new_keys is not None:
+                new_keys.append(key)
+            return False
+
+    def commit(self, new_keys):
+        # The games of new_keys are in the file now.
+        with self.lock:
+            for key in new_keys:
+                self.pending.discard(key)
+                self.remember(key)
+
+    def release(self, new_keys):
+        # The games of new_keys won't be written after all, so a copy that comes later can be.
+        with self.lock:
+            for key in new_keys:
+                self.pending.discard(key)
+
+    def bit_positions(self, key):
+        step = (key >> 32) | 1
+        return [(key + i * step) % self.num_bits for i in range(self.num_hashes)]
+
+    def remember(self, key):
+        for bit in self.bit_positions(key):
+            self.bits[bit >> 3] |= 1 << (bit & 7)
+        self.keys.add(key)
+        if len(self.keys) >= self.max_in_memory and self.path_dedup is not None:
+            self.spill()
+
+    def is_known(self, key):
+        if key in self.keys:
+            return True
+        for run_name, run_keys in self.runs:
+            i = bisect.bisect_left(run_keys, key)
+            if i < len(run_keys) and run_keys[i] == key:
+                return True
+        return False
+
+    def spill(self):
+        os.makedirs(self.path_dedup, exist_ok=True)
+        self.add_run(array.array('Q', sorted(self.keys)))
+        self.keys.clear()
+
+        if len(self.runs) > self.max_runs:  # Fewer files to look in for every maybe.
+            merged = array.array('Q', heapq.merge(*[run_keys for run_name, run_keys in self.runs]))
+            old_runs = self.runs
+            self.runs = []
+            self.add_run(merged)
+            for run_name, run_keys in old_runs:
+                if isinstance(run_keys, memoryview):  # Windows can't remove a file that's still mapped.
+                    run_mm = run_keys.obj
+                    run_keys.release()
+                    run_mm.close()
+                if self.deferred:  # Removed once the next save doesn't need them.
+                    self.stale_runs.append(run_name)
+                else:
+                    os.remove(os.path.join(self.path_dedup, run_name))
+
+    def add_run(self, sorted_keys):
+        run_name = 'keys_' + str(self.next_run).zfill(5) + '.bin'
+        self.next_run += 1
+        self.write_keys(run_name, sorted_keys)
+        self.runs.append((run_name, self.open_run(run_name)))
+
+    def write_keys(self, file_name, sorted_keys):
+        with open(os.path.join(self.path_dedup, file_name + '.tmp'), 'wb') as f:
+            sorted_keys.tofile(f)
+        os.replace(os.path.join(self.path_dedup, file_name + '.tmp'), os.path.join(self.path_dedup, file_name))
+
+    def open_run(self, run_name):
+        with open(os.path.join(self.path_dedup, run_name), 'rb') as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return array.array('Q')
+            return memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)).cast('Q')
+
+    def save(self, pgn_path, clean=False):
+        # pgn_path has exactly the games of the keys, so they stay good as long as it doesn't get
+        # shorter. Nothing the last manifest points at is overwritten, so a crash keeps the last save.
+        # clean is only for the save after the writer's last game, so a crashed run can be told apart.
+        with self.lock:
+            os.makedirs(self.path_dedup, exist_ok=True)
+            with open(os.path.join(self.path_dedup, 'bloom.bin.tmp'), 'wb') as f:
+                f.write(self.bits)
+            os.replace(os.path.join(self.path_dedup, 'bloom.bin.tmp'), os.path.join(self.path_dedup, 'bloom.bin'))
+
+            # The newest keys too, instead of spilling them into another run every save.
+            old_recent = self.recent_name
+            self.recent_name = 'recent_' + str(self.next_run).zfill(5) + '.bin'
+            self.next_run += 1
+            self.write_keys(self.recent_name, array.array('Q', sorted(self.keys)))
+
+            write_json_atomic(os.path.join(self.path_dedup, 'dedup.json'),
+                              {'num_bits': self.num_bits, 'num_hashes': self.num_hashes,
+                               'runs': [run_name for run_name, run_keys in self.runs], 'recent': self.recent_name,
+                               'next_run': self.next_run, 'pgn_path': os.path.abspath(pgn_path),
+                               'pgn_size': os.path.getsize(pgn_path) if os.path.exists(pgn_path) else 0,
+                               'clean': clean})
+
+            for file_name in self.stale_runs + ([old_recent] if old_recent is not None else []):
+                os.remove(os.path.join(self.path_dedup, file_name))
+            self.stale_runs = []
+
+    def load(self, pgn_path, keep_unsaved=False):
+        # Games past the saved size are never removed. If the last run ended cleanly, they were added
+        # some other way (by hand, or without dedup) and are just kept. If it crashed, they're the
+        # ones written after its last save, and since their keys were lost, a rerun could write them
+        # again. Their keys can't be made again from the stripped games, so unless keep_unsaved says
+        # that's fine, it stops for the user to decide.
+        try:
+            with open(os.path.join(self.path_dedup, 'dedup.json'), 'r') as f:
+                manifest = json.load(f)
+        except FileNotFoundError:
+            return
+
+        # Only this file's keys start over, whatever happens to the others.
+        if manifest.get('pgn_path') != os.path.abspath(pgn_path):
+            reason = "Dedup is for a different pgn file."
+        elif not os.path.exists(pgn_path) or os.path.getsize(pgn_path) < manifest['pgn_size']:
+            reason = "Games were removed from " + pgn_path + "."
+        elif not all(os.path.exists(os.path.join(self.path_dedup, file_name))
+                     for file_name in manifest['runs'] + [manifest['recent']]):
+            reason = "Dedup runs are missing."
+        elif manifest['num_bits'] != self.num_bits or manifest['num_hashes'] != self.num_hashes:
+            reason = "Dedup was made with a different capacity."
+        else:
+            reason = None
+        if reason is not None:
+            print(reason, "Starting it over.")
+            shutil.rmtree(self.path_dedup)
+            return
+
+        if os.path.getsize(pgn_path) > manifest['pgn_size']:
+            if not manifest.get('clean') and not keep_unsaved:
+                raise ValueError("The last run on " + pgn_path + " didn't finish, so the games after byte " +
+                                 str(manifest['pgn_size']) + " aren't in its dedup and could be written "
+                                 "twice. Move them out of the file, or set keep_unsaved_games to keep them.")
+            print("Games after byte", manifest['pgn_size'], "of", pgn_path, "are kept, but aren't deduplicated.")
+
+        with open(os.path.join(self.path_dedup, 'bloom.bin'), 'rb') as f:
+            self.bits = bytearray(f.read())
+        self.runs = [(run_name, self.open_run(run_name)) for run_name in manifest['runs']]
+        with open(os.path.join(self.path_dedup, manifest['recent']), 'rb') as f:
+            recent = array.array('Q')
+            recent.frombytes(f.read())
+        self.keys = set(recent)
+        self.recent_name = manifest['recent']
+        self.next_run = manifest['next_run']
+
+
+class CountMinSketch(object):
+    # depth rows of width counters, each one a packed int like PACKED_RESULT. After N positions
+    # have been added, the estimate for a position is never below its real count and is above it
+    # by at most e / width * N with probability at least 1 - e^-depth. With the defaults
+    # (width 2^20, depth 4), that's within 2.6 games per million positions added, 98% of the time.
+    SKETCH_HEADER = struct.Struct('<IIQ')
+
+    def __init__(self, width=1 << 20, depth=4):
+        self.width = width
+        self.depth = depth
+        self.rows = [array.array('Q', bytes(8 * width)) for _ in range(depth)]
+        self.total = 0
+
+    def add(self, key, packed):
+        # key is a 64 bit hash. Returns the packed counts of the row with the fewest games.
+        step = (key >> 32) | 1
+        best = None
+        for i in range(self.depth):
+            row = self.rows[i]
+            j = (key + i * step) % self.width
+            row[j] += packed
+            if best is None or row[j] & 0xFFFFFFFF < best & 0xFFFFFFFF:
+                best = row[j]
+        self.total += 1
+        return best
+
+    def error_bound(self):
+        # In games, for 1 - e^-depth of the positions.
+        return math.e / self.width * self.total
+
+    def save(self, file_path):
+        with open(file_path + '.tmp', 'wb') as f:
+            f.write(self.SKETCH_HEADER.pack(self.width, self.depth, self.total))
+            for row in self.rows:
+                row.tofile(f)
+        os.replace(file_path + '.tmp', file_path)
+
+    def load(self, file_path):
+        with open(file_path, 'rb') as f:
+            self.width, self.depth, self.total = self.SKETCH_HEADER.unpack(f.read(self.SKETCH_HEADER.size))
+            self.rows = []
+            for _ in range(self.depth):
+                row = array.array('Q')
+                row.fromfile(f, self.width)
+                self.rows.append(row)
+
+
+def sketch_key(board_fen):
+    # Same in every process, unlike hash().
+    return int.from_bytes(hashlib.blake2b(board_fen.encode(), digest_size=8).digest(), 'little')
+
+
+class Metrics(object):
+    # Counters, gauges and latency histograms. Every flush_every seconds they go to
+    # <name>_metrics.jsonl (with rates since the last flush) and <name>.prom for Prometheus'
+    # textfile collector. Without path_metrics nothing gets written.
+    # Names can have Prometheus labels, e.g. 'http_responses{status="200"}'.
+    # With profile_every=N, every Nth call inside profiled() runs under cProfile.
+    BUCKETS = [0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+
+    def __init__(self, path_metrics=None, name='metrics', flush_every=10, profile_every=0):
+        self.path_metrics = path_metrics
+        self.name = name
+        self.flush_every = flush_every
+        self.profile_every = profile_every
+        if path_metrics is not None:
+            os.makedirs(path_metrics, exist_ok=True)
+
+        self.lock = Lock()
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}  # name -> [count per bucket (last one is +Inf), sum]
+        self.calls = {}
+        self.profiles = {}
+        self.started = time.time()
+        self.last_flush = self.started
+        self.last_counters = {}
+
+    def inc(self, counter, value=1):
+        with self.lock:
+            self.counters[counter] = self.counters.get(counter, 0) + value
+
+    def set(self, gauge, value):
+        self.gauges[gauge] = value
+
+    def observe(self, histogram, seconds):
+        with self.lock:
+            if histogram not in self.histograms:
+                self.histograms[histogram] = [[0] * (len(self.BUCKETS) + 1), 0]
+            self.histograms[histogram][0][bisect.bisect_left(self.BUCKETS, seconds)] += 1
+            self.histograms[histogram][1] += seconds
+
+    @contextlib.contextmanager
+    def timer(self, histogram):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(histogram, time.perf_counter() - start)
+
+    @contextlib.contextmanager
+    def profiled(self, name):
+        if not self.profile_every:
+            yield
+            return
+        self.calls[name] = self.calls.get(name, 0) + 1
+        if self.calls[name] % self.profile_every != 0:
+            yield
+            return
+
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            yield
+        finally:
+            profiler.disable()
+            with self.lock:
+                if name in self.profiles:
+                    self.profiles[name].add(profiler)
+                else:
+                    self.profiles[name] = pstats.Stats(profiler)
+
+    def tick(self):
+        # Cheap enough to call after every game or request.
+        if time.time() - self.last_flush >= self.flush_every:
+            self.flush()
+
+    def flush(self):
+        with self.lock:
+            now = time.time()
+            elapsed = max(now - self.last_flush, 1e-9)
+            rates = {counter + '_per_sec': (value - self.last_counters.get(counter, 0)) / elapsed
+                     for counter, value in self.counters.items()}
+            histograms = {}
+            for histogram, (counts, total) in self.histograms.items():
+                histograms[histogram] = {'count': sum(counts), 'sum': total,
+                                         'buckets': dict(zip([str(le) for le in self.BUCKETS] + ['+Inf'], counts))}
+            record = {'time': datetime.datetime.now().isoformat(), 'uptime': now - self.started,
+                      'counters': dict(self.counters), 'rates': rates, 'gauges': dict(self.gauges),
+                      'histograms': histograms}
+            self.last_counters = dict(self.counters)
+            self.last_flush = now
+            if self.path_metrics is None:
+                return record
+
+            with open(os.path.join(self.path_metrics, self.name + '_metrics.jsonl'), 'a') as f:
+                f.write(json.dumps(record) + '\n')
+            self.write_prometheus(record)
+            for name, stats in self.profiles.items():
+                stats.dump_stats(os.path.join(self.path_metrics, self.name + '_' + name + '.prof'))
+
+        return record
+
+    def write_prometheus(self, record):
+        lines = []
+        for counter, value in sorted(record['counters'].items()):
+            lines.append('opening_oracle_' + self.name + '_' + counter + ' ' + str(value))
+        for gauge, value in sorted(record['gauges'].items()):
+            lines.append('opening_oracle_' + self.name + '_' + gauge + ' ' + str(value))
+        for histogram, stats in sorted(record['histograms'].items()):
+            metric = 'opening_oracle_' + self.name + '_' + histogram
+            cumulative = 0
+            for le, count in stats['buckets'].items():
+                cumulative += count
+                lines.append(metric + '_bucket{le="' + le + '"} ' + str(cumulative))
+            lines.append(metric + '_sum ' + str(stats['sum']))
+            lines.append(metric + '_count ' + str(stats['count']))
+
+        # Written to a temp file first so the collector never reads half of it.
+        file_path = os.path.join(self.path_metrics, self.name + '.prom')
+        with open(file_path + '.tmp', 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        os.replace(file_path + '.tmp', file_path)
 
 
 def get_first_parameters():
@@ -38,18 +811,40 @@ def get_first_parameters():
 
 
 class DownloadPGNs(object):
-    def __init__(self, elo_from, elo_to, path_save, game_type='blitz'):
+    # With bucket_size (e.g. 100), games of every time control are kept and each one is tagged
+    # with its time control and average elo band, so one download covers every range.
+    # by_month writes each month to its own Months/<YYYY-MM>/all_pgns.pgn, for MonthlyStores.
+    # A game between two players in the range is in both their archives. dedup_capacity is about how
+    # many games GameDeduplicator is sized for, so it's only kept once. None keeps both.
+    def __init__(self, elo_from, elo_to, path_save, game_type='blitz', bucket_size=None, by_month=False,
+                 dedup_capacity=10000000):
         self.elo_from = elo_from
         self.elo_to = elo_to
         self.game_type = game_type
+        self.bucket_size = bucket_size
+        self.by_month = by_month
 
         self.path_save = path_save
         self.path_games = os.path.join(
             self.path_save, "JSONS", "Multi-PGN Games", self.game_type)
-
-    def download_usernames(self, by_country=False):
-        self.all_usernames = []
-
+        # Can be pointed at a local server for testing.
+        self.api_url = "https://api.chess.com"
+        # For rate limits (429) and server errors (5xx), with a backoff that doubles each time.
+        self.max_http_retries = 5
+        # Shared by every elo range and game type. Set to None to always download.
+        self.archive_cache = ArchiveCache(os.path.join(self.path_save, "Archive Cache"))
+        # Ending it in .gz makes the writer compress it.
+        self.pgn_file_name = 'all_pgns.pgn'
+        self.writer = None
+        self.writers = {}  # (year, month) -> PGNWriter, with by_month.
+        self.dedup_capacity = dedup_capacity
+        # A crashed run leaves games its dedup doesn't know about. True keeps them, risking duplicates.
+        self.keep_unsaved_games = False
+        self.dedup = None  # For stripping without a writer. Each writer has its own file's.
+        # Replace with Metrics(path, 'download') to have them written out.
+        self.metrics = Metrics()
+
+    def download_usernames(self, by_country=False, num_workers=4):
         if by_country:
             # TOP 10 countries by population of masters.
             country_list = [('France', '52'), ('Germany', '54'), ('Hungary', '67'), ('India', '69'), ('Poland', '112'), (
@@ -57,62 +852,179 @@ class DownloadPGNs(object):
         else:
             country_list = [('All', '0')]
 
-        for country in country_list:
-            # Approx. 100 usernames/elo.
-            for rating in range(self.elo_from, self.elo_to+1, 1):
-                while True:
-                    try:
-                        scraper = cloudscraper.create_scraper()
-                        if country[0] == 'All':
-                            response = scraper.get(f'https://www.chess.com/members/search?rating_type={self.game_type}&rating_min={rating}&rating_max={rating}&coaches=0&streamers=0&titledMembers=0&sortBy=last_login_date', headers={
-                                'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/98.0.4758.82 Safari/537.36'})
-                        else:
-                            response = scraper.get(f'https://www.chess.com/members/search?country={country[1]}&rating_type={self.game_type}&rating_min={rating}&rating_max={rating}&coaches=0&streamers=0&titledMembers=0&sortBy=last_login_date', headers={
-                                'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/98.0.4758.82 Safari/537.36'})
-
-                        soup = BeautifulSoup(response.text, "lxml")
-                        all_usernames_of_level = soup.find_all(
-                            "a", attrs={'class': 'members-list-username'})
-
-                        for user in all_usernames_of_level:
-                            self.all_usernames.append(
-                                user.text[23:-21].lower())
-                            print(user)
-
-                        time.sleep(.5)
-                        break  # To get out of while loop.
-
-                    except:
-                        print(
-                            'Problem with:', f'https://www.chess.com/members/search?rating_type={self.game_type}&rating_min={rating}&rating_max={rating+1}&coaches=0&streamers=0&titledMembers=0&sortBy=last_login_date')
-                        print(traceback.format_exc())
-                        time.sleep(30)
-
-            print("Finished this country:", country[0])
-
-        # Remove duplicates.
-        self.all_usernames = list(set(self.all_usernames))
-        with open(os.path.join(self.path_save, "Usernames", self.game_type + "_names.txt"), 'w') as f:
-            f.write(str(self.all_usernames))
-
-        print(len(self.all_usernames), "usernames found.")
+        path_names = os.path.join(self.path_save, "Usernames", self.game_type + "_names.txt")
+        # One line per finished (country, rating) page, so a restart skips them.
+        path_done = os.path.join(self.path_save, "Usernames", self.game_type + "_names_done.txt")
+        os.makedirs(os.path.dirname(path_names), exist_ok=True)
+        self.convert_old_usernames(path_names)
+
+        done_pages = set()
+        if os.path.exists(path_done):
+            with open(path_done, 'r') as f:
+                done_pages = set(f.read().split())
+
+        # Approx. 100 usernames/elo.
+        pages = [(country, rating) for country in country_list
+                 for rating in range(self.elo_from, self.elo_to+1, 1)
+                 if country[1] + ':' + str(rating) not in done_pages]
+        print(len(pages), "pages to go.", len(done_pages), "already done.")
+
+        # A few sessions that get passed around instead of a new one for every request.
+        self.scrapers = queue.Queue()
+        for _ in range(num_workers):
+            self.scrapers.put(cloudscraper.create_scraper())
+        self.usernames_lock = Lock()
+
+        with open(path_names, 'a') as names_file, open(path_done, 'a') as done_file:
+            executor = concurrent.futures.ThreadPoolExecutor(max_workers=num_workers)
+            for country, rating in pages:
+                executor.submit(self.download_usernames_page, country, rating, names_file, done_file)
+            executor.shutdown(wait=True)
+
+        self.load_usernames()
+
+    def members_search_url(self, country, rating):
+        if country[0] == 'All':
+            return f'https://www.chess.com/members/search?rating_type={self.game_type}&rating_min={rating}&rating_max={rating}&coaches=0&streamers=0&titledMembers=0&sortBy=last_login_date'
+        return f'https://www.chess.com/members/search?country={country[1]}&rating_type={self.game_type}&rating_min={rating}&rating_max={rating}&coaches=0&streamers=0&titledMembers=0&sortBy=last_login_date'
+
+    def download_usernames_page(self, country, rating, names_file, done_file):
+        wait = 2
+        while True:
+            scraper = self.scrapers.get()
+            try:
+                with self.metrics.timer('usernames_request_seconds'):
+                    response = scraper.get(self.members_search_url(country, rating), headers={
+                        'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/98.0.4758.82 Safari/537.36'})
+                self.metrics.inc('usernames_responses{status="' + str(response.status_code) + '"}')
+                self.metrics.inc('bytes_downloaded', len(response.content))
+
+                soup = BeautifulSoup(response.text, "lxml")
+                all_usernames_of_level = soup.find_all(
+                    "a", attrs={'class': 'members-list-username'})
+                usernames = [user.text[23:-21].lower() for user in all_usernames_of_level]
+
+                # Names first, then the page is marked done. A crash in between only means duplicates.
+                with self.usernames_lock:
+                    for username in usernames:
+                        names_file.write(username + '\n')
+                    names_file.flush()
+                    done_file.write(country[1] + ':' + str(rating) + '\n')
+                    done_file.flush()
+
+                print(country[0], rating, len(usernames), "usernames")
+                self.metrics.inc('usernames_found', len(usernames))
+                self.metrics.inc('usernames_pages')
+                self.metrics.tick()
+                self.scrapers.put(scraper)
+                time.sleep(.5)
+                return
 
-    def load_usernames(self):  # For backwards compatibility.
-        with open(os.path.join(self.path_save, "Usernames", self.game_type + "_names.txt"), 'r') as f:
-            self.all_usernames = eval(f.read())
+            except:
+                print('Problem with:', self.members_search_url(country, rating))
+                print(traceback.format_exc())
+                self.metrics.inc('http_retries')
+                # Probably cloudflare, so get a fresh session and back off.
+                self.scrapers.put(cloudscraper.create_scraper())
+                time.sleep(wait)
+                wait = min(wait * 2, 30)
+
+    def convert_old_usernames(self, path_names):
+        # Old files are one python list. Turn them into one username per line.
+        if not os.path.exists(path_names):
+            return
+        with open(path_names, 'r') as f:
+            if f.read(1) != '[':
+                return
+            f.seek(0)
+            old_usernames = ast.literal_eval(f.read())
+
+        with open(path_names + '.tmp', 'w') as f:
+            for username in old_usernames:
+                f.write(username + '\n')
+        os.replace(path_names + '.tmp', path_names)
+
+    def load_usernames(self):
+        path_names = os.path.join(self.path_save, "Usernames", self.game_type + "_names.txt")
+        self.convert_old_usernames(path_names)
+
+        # Remove duplicates, keeping the order they were found in.
+        all_usernames = {}
+        with open(path_names, 'r') as f:
+            for line in f:
+                username = line.strip()
+                if username:
+                    all_usernames[username] = None
+        self.all_usernames = list(all_usernames)
 
         print(len(self.all_usernames), "usernames loaded.")
 
     def download_games(self, num_months=6):
         year, months = self.calc_dates(num_months=num_months, include_curr_month=True)
+        self.download_months(year, months)
+
+    def download_month(self, year, month):
+        # Only one month, e.g. the one that just ended. Best with by_month, for MonthlyStores.refresh.
+        self.download_months(str(year), [str(month).zfill(2)])
+
+    def download_months(self, year, months):
         print("Months:", months)
 
+        self.start_writer(year, months)
+
         # At 25 workers, you're downloading 500 users/min or 1000 pgns/min. Uses 16 MB/sec.
         executor = concurrent.futures.ThreadPoolExecutor(max_workers=25)
         for user in self.all_usernames:
             executor.submit(self.download_user, user, year, months)
 
         executor.shutdown(wait=True)
+        self.close_writers()
+        self.metrics.flush()
+
+    def start_writer(self, year=None, months=None):
+        if not self.by_month:
+            os.makedirs(self.path_games, exist_ok=True)
+            self.writer = self.open_writer(self.path_games)
+        else:
+            # Each month goes next to the partial store that gets made from it.
+            for month_year, month in self.user_months(year, months):
+                path_month = os.path.join(self.path_save, 'Months', month_year + '-' + month)
+                os.makedirs(path_month, exist_ok=True)
+                self.writers[(month_year, month)] = self.open_writer(path_month)
+
+    def open_writer(self, path_games):
+        # The dedup goes next to its file and is kept between runs, since the file gets appended
+        # to. Dropping a month drops its dedup with it.
+        file_path = os.path.join(path_games, self.pgn_file_name)
+        dedup = None
+        if self.dedup_capacity:
+            dedup = GameDeduplicator(os.path.join(path_games, 'Dedup'), self.dedup_capacity, deferred=True)
+            dedup.load(file_path, self.keep_unsaved_games)
+        writer = PGNWriter(file_path, dedup=dedup)
+        writer.start()
+        return writer
+
+    def writer_for(self, year=None, month=None):
+        if self.by_month:
+            return self.writers.get((year, month))
+        return self.writer
+
+    def close_writers(self):
+        writers = list(self.writers.values())
+        if self.writer is not None:
+            writers.append(self.writer)
+        self.writer = None
+        self.writers = {}
+
+        games, duplicates = 0, 0
+        for writer in writers:
+            writer.close()
+            if writer.dedup is not None:
+                games += writer.dedup.games
+                duplicates += writer.dedup.duplicates
+        if self.dedup_capacity:
+            print("Dropped", duplicates, "duplicate games out of", games)
+            self.metrics.set('duplicate_games_ratio', duplicates / max(games, 1))
 
     def calc_dates(self, num_months=6, include_curr_month=True):
         year = str(datetime.datetime.now().year)
@@ -133,102 +1045,237 @@ class DownloadPGNs(object):
 
         return year, months
 
-    def download_user(self, user, start_year, months):
-        global lo
-
+    def user_months(self, start_year, months):
+        # Months go back in time, so when the month number goes up it's the year before.
         last_month = months[0]
         for month in months:
             if int(month) > int(last_month):
                 start_year = str(int(start_year)-1)
-            try:
-                user_pgn = self.download_pgn(user, start_year, month)
-                user_pgn = self.strip_user_pgn(user_pgn)
+            yield start_year, month
+            last_month = month
 
-                with lo:
-                    with open(self.path_games + "\\" + 'all_pgns.pgn', 'a') as pgn_file:
-                        pgn_file.write(user_pgn)
+    def download_user(self, user, start_year, months):
+        for year, month in self.user_months(start_year, months):
+            try:
+                with self.metrics.profiled('download_pgn'):
+                    user_pgn = self.download_pgn(user, year, month)
+                with self.metrics.profiled('strip_user_pgn'):
+                    stripper = self.strip_archive(user_pgn, year, month)
+                self.write_user_pgn(stripper.stripped_pgn(), year, month, stripper.new_keys)
             except:
                 print(traceback.format_exc())
-            
-            last_month = month
+                self.metrics.inc('download_errors')
 
         print(user, 'downloaded')
+        self.metrics.inc('users_downloaded')
+        self.metrics.tick()
+
+    def count_games_kept(self, user_pgn):
+        if user_pgn:
+            self.metrics.inc('games_kept', user_pgn.count('\n') + 1)
+
+    def write_user_pgn(self, user_pgn, year=None, month=None, new_keys=None):
+        self.count_games_kept(user_pgn)
+        self.writer_for(year, month).write(user_pgn, new_keys)
 
     def download_pgn(self, user, year, month):
-        response = requests.get(
-            f"https://api.chess.com/pub/player/{user}/games/{year}/{month}/pgn")
+        cached, meta = None, None
+        if self.archive_cache is not None:
+            cached, meta = self.archive_cache.load(user, year, month)
+            if cached is not None and self.archive_cache.is_final(meta, year, month):
+                self.metrics.inc('archive_cache_hits')
+                return cached.decode()
+
+        with self.metrics.timer('http_request_seconds'):
+            response = requests.get(f"{self.api_url}/pub/player/{user}/games/{year}/{month}/pgn",
+                                    headers=self.archive_cache.conditional_headers(meta) if self.archive_cache else {})
+        self.metrics.inc('http_responses{status="' + str(response.status_code) + '"}')
+        self.metrics.inc('bytes_downloaded', len(response.content))
+
+        if response.status_code == 304 and cached is not None:  # Hasn't changed since last time.
+            self.archive_cache.save_meta(user, year, month, response.headers, meta)
+            return cached.decode()
+        if response.status_code == 200 and self.archive_cache is not None:
+            self.archive_cache.save(user, year, month, response.headers, response.content)
 
         return str(response.text)
 
-    def strip_user_pgn(self, user_pgn):
-        accepted_time = False
-        accepted_elo = False
-        accepted_type = False
-        new_pgn = []
+    def download_games_async(self, num_months=6, max_in_flight=50, max_per_host=50):
+        # Same as download_games, but one thread with reused keep-alive connections.
+        if aiohttp is None:
+            raise ImportError("download_games_async needs aiohttp (pip install aiohttp).")
+
+        year, months = self.calc_dates(num_months=num_months, include_curr_month=True)
+        print("Months:", months)
+
+        self.start_writer(year, months)
+        asyncio.run(self.async_download_users(year, months, max_in_flight, max_per_host))
+        self.close_writers()
+        self.metrics.flush()
+
+    async def async_download_users(self, year, months, max_in_flight, max_per_host):
+        connector = aiohttp.TCPConnector(limit=max_in_flight, limit_per_host=max_per_host)
+        async with aiohttp.ClientSession(connector=connector) as session:
+            # A small queue instead of one task per user, so memory doesn't depend on the user count.
+            user_queue = asyncio.Queue(maxsize=max_in_flight * 2)
+            workers = [asyncio.create_task(self.async_download_worker(session, user_queue, year, months))
+                       for _ in range(max_in_flight)]
+
+            for user in self.all_usernames:
+                await user_queue.put(user)
+            for _ in workers:
+                await user_queue.put(None)  # Tells the worker to stop.
+
+            await asyncio.gather(*workers)
 
+    async def async_download_worker(self, session, user_queue, start_year, months):
+        while True:
+            user = await user_queue.get()
+            if user is None:
+                return
+
+            for year, month in self.user_months(start_year, months):
+                try:
+                    stripper = await self.async_download_pgn(session, user, year, month)
+                    # The writer's queue can be full, so it waits in a thread instead of the event loop.
+                    await asyncio.to_thread(self.write_user_pgn, stripper.stripped_pgn(), year, month,
+                                            stripper.new_keys)
+                except Exception:
+                    print(traceback.format_exc())
+                    self.metrics.inc('download_errors')
+
+            print(user, 'downloaded')
+            self.metrics.inc('users_downloaded')
+            self.metrics.tick()
+
+    async def async_download_pgn(self, session, user, year, month):
+        # Lines go to the stripper as they arrive instead of buffering the whole archive.
+        stripper = PGNStripper(self, year, month)
+
+        cached, meta = None, None
+        if self.archive_cache is not None:
+            cached, meta = self.archive_cache.load(user, year, month)
+            if cached is not None and self.archive_cache.is_final(meta, year, month):
+                self.metrics.inc('archive_cache_hits')
+                return self.strip_archive(cached.decode(), year, month)
+
+        url = f"{self.api_url}/pub/player/{user}/games/{year}/{month}/pgn"
+        wait = 1
+        for attempt in range(self.max_http_retries + 1):
+            if attempt:
+                self.metrics.inc('http_retries')
+                await asyncio.sleep(wait)
+                wait = min(wait * 2, 30)
+
+            start = time.perf_counter()
+            async with session.get(url, headers=self.archive_cache.conditional_headers(meta)
+                                   if self.archive_cache else {}) as response:
+                self.metrics.inc('http_responses{status="' + str(response.status) + '"}')
+                if response.status == 429 or response.status >= 500:  # Rate limited or a server error.
+                    continue
+                if response.status == 304 and cached is not None:  # Hasn't changed since last time.
+                    self.metrics.observe('http_request_seconds', time.perf_counter() - start)
+                    self.archive_cache.save_meta(user, year, month, response.headers, meta)
+                    return self.strip_archive(cached.decode(), year, month)
+                if response.status != 200:  # e.g. 404, so there are no games to strip.
+                    print("No games for", user, year, month, "- status", response.status)
+                    return stripper
+
+                archive_file = None
+                if self.archive_cache is not None:
+                    archive_file = self.archive_cache.open_archive(user, year, month)
+
+                leftover = b''
+                try:
+                    async for chunk in response.content.iter_chunked(1 << 16):
+                        self.metrics.inc('bytes_downloaded', len(chunk))
+                        if archive_file is not None:
+                            archive_file.write(chunk)
+                        lines = (leftover + chunk).split(b'\n')
+                        leftover = lines.pop()
+                        for line in lines:
+                            stripper.feed(line.decode().rstrip('\r'))
+                    if leftover:
+                        stripper.feed(leftover.decode().rstrip('\r'))
+
+                    if archive_file is not None:
+                        archive_file.close()
+                        self.archive_cache.save(user, year, month, response.headers)
+                except BaseException:  # Cancelled too.
+                    stripper.release()  # None of it gets written.
+                    if archive_file is not None:
+                        archive_file.close()
+                        self.archive_cache.discard(user, year, month)
+                    raise
+            # Time to the end of the body, like requests.get.
+            self.metrics.observe('http_request_seconds', time.perf_counter() - start)
+
+            return stripper
+
+        self.metrics.inc('http_failures')
+        raise RuntimeError("Gave up on " + url + " after " + str(self.max_http_retries) + " retries.")
+
+    def strip_archive(self, user_pgn, year=None, month=None):
+        stripper = PGNStripper(self, year, month)
         for line in user_pgn.splitlines():
-            if line.startswith('[Event'):  # New game.
-                accepted_type = True
-            elif line.startswith('[Variant'):  # Don't want any variants.
-                accepted_type = False
-            elif line.startswith('[TimeControl'):
-                accepted_time = self.is_ok_time_control(line)
-
-            elif line.startswith('[WhiteElo') and int(line[11:len(line)-2]) >= self.elo_from and int(line[11:len(line)-2]) <= self.elo_to:
-                accepted_elo = True
-            elif line.startswith('[BlackElo') and int(line[11:len(line)-2]) >= self.elo_from and int(line[11:len(line)-2]) <= self.elo_to:
-                accepted_elo = True
-
-            elif accepted_time and accepted_elo and accepted_type and line.startswith('1.'):
-                stripped_pgn = self.delete_extra_parts_pgn(line)
-                if stripped_pgn != 'invalid':
-                    opening_pgn = self.keep_only_opening(stripped_pgn)
-                    if opening_pgn != '':
-                        new_pgn.append(opening_pgn)
-                else:
-                    print(line)
-                accepted_time = False
-                accepted_elo = False
+            stripper.feed(line)
 
-        return '\n'.join(new_pgn)
+        return stripper
+
+    def strip_user_pgn(self, user_pgn):
+        return self.strip_archive(user_pgn).stripped_pgn()
 
     def is_ok_time_control(self, line):
-        time_controls = {'bullet': (0, 180), 'blitz': (
-            180, 600), 'rapid': (600, 3600)}
+        # Takes the whole '[TimeControl "180+2"]' line.
+        return self.is_ok_game_type(self.time_control_type(line[14:len(line)-2]))
 
-        plus_sign = line.find('+')
-        # With increment.
-        if plus_sign != -1 and int(line[14:plus_sign]) + int(line[plus_sign+1:len(line)-2])*60 >= time_controls[self.game_type][0] and int(line[14:plus_sign]) + int(line[plus_sign+1:len(line)-2])*60 < time_controls[self.game_type][1]:
-            return True
-        # Daily time controls are not a valid game type.
-        elif line.find('/') != -1:
-            return False
-        # No increment
-        elif plus_sign == -1 and int(line[14:len(line)-2]) >= time_controls[self.game_type][0] and int(line[14:len(line)-2]) < time_controls[self.game_type][1]:
-            return True
-        else:
+    def is_ok_game_type(self, time_type):
+        if self.bucket_size:
+            return time_type is not None
+        return time_type == self.game_type
+
+    def time_control_type(self, time_control):
+        # Daily time controls (e.g. '1/86400') are not a valid game type.
+        if '/' in time_control:
+            return None
+
+        base, _, increment = time_control.partition('+')
+        try:
+            total = int(base) + int(increment or 0) * 60
+        except ValueError:  # '-' or something else we can't use.
+            return None
+
+        for game_type, (time_from, time_to) in TIME_CONTROLS.items():
+            if time_from <= total < time_to:
+                return game_type
+        return None
+
+    def is_ok_elo(self, elo):
+        try:
+            return self.elo_from <= int(elo) <= self.elo_to
+        except ValueError:  # e.g. '?'
             return False
 
-    def delete_extra_parts_pgn(self, line):
-        num_open_brackets = 0
-        in_brackets = False
-        stripped_down_s = ""
+    def game_bucket(self, time_type, elos):
+        # e.g. 'blitz_1500' for a blitz game where the players average 1500-1599.
+        try:
+            average = sum(int(elo) for elo in elos) // len(elos)
+        except (ValueError, ZeroDivisionError):
+            return None
+        if not self.is_ok_elo(average):
+            return None
+        return time_type + '_' + str(average - average % self.bucket_size)
 
-        if line[2] == '.':
+    def delete_extra_parts_pgn(self, line):
+        # Removes comments (clock times), black's move numbers and annotations. Linear in the
+        # length of the line.
+        if line[2:3] == '.':
             return "invalid"
 
-        for i in range(len(line)):
-            if line[i] == '{':
-                num_open_brackets += 1
-                in_brackets = True
-            elif line[i] == '}':
-                in_brackets = False
-            elif not in_brackets and i > 1 and line[i] == '.' and line[i-1] == '.' and line[i-2] == '.':
-                while stripped_down_s[len(stripped_down_s)-1] != ' ':
-                    stripped_down_s = stripped_down_s[:-1]
-                stripped_down_s = stripped_down_s[:-1]  # Remove that space.
-            elif not in_brackets and not (not in_brackets and i > 0 and line[i] == ' ' and stripped_down_s[len(stripped_down_s)-1] == ' '):
-                stripped_down_s += line[i]
+        line = COMMENT_RE.sub(' ', line)
+        line = BLACK_MOVE_NUM_RE.sub(' ', line)
+        line = ANNOTATION_RE.sub(' ', line)
+        return ' '.join(line.split())
 
     def keep_only_opening(self, line):
         split_line = line.split(' ')
@@ -245,70 +1292,861 @@ class DownloadPGNs(object):
         final_line = ' '.join(split_line)
         return final_line
 
-    def fix_all_pgns(self):
-        # Threading leads to some newlines not being printed.
-        with open(self.path_games + "\\" + 'all_pgns.pgn') as f:
-            all_pgns = f.read()
-
-        # Search for '0-11' or '1-01' or '1/21' in the file and if found, insert a '\n' before the last 1.
-        all_pgns = all_pgns.replace('0-11', '0-1\n1')
-        all_pgns = all_pgns.replace('1-01', '1-0\n1')
-        all_pgns = all_pgns.replace('1/21', '1/2\n1')
-        print("Finished replacing.")
-
-        # Won't need this this time. Only for backwards compatibility.
-        new_pgns = []
-        for line in all_pgns:
-            opening_pgn = self.keep_only_opening(line)
-            if opening_pgn != '':
-                new_pgns.append(opening_pgn)
-
-            if random.randint(0, 100000) == 0:
+
+class PGNStripper(object):
+    # What strip_user_pgn does, one line at a time, so a download can be stripped while it streams.
+    def __init__(self, downloader, year=None, month=None):
+        self.downloader = downloader
+        # The dedup of the file the games go to, or the downloader's when there's no writer.
+        writer = downloader.writer_for(year, month)
+        self.dedup = writer.dedup if writer is not None else downloader.dedup
+        self.new_keys = []  # Of the games kept, for the writer to commit once they're written.
+        self.accepted_time = False
+        self.accepted_elo = False
+        self.accepted_type = False
+        self.time_type = None
+        self.elos = []
+        self.headers = []
+        self.link = None
+        self.new_pgn = []
+
+    def feed(self, line):
+        downloader = self.downloader
+
+        if line.startswith('['):
+            # Each header is split once, e.g. '[WhiteElo "1234"]' -> 'WhiteElo', '1234'.
+            tag, _, value = line[1:].partition(' ')
+            value = value[1:-2]
+
+            if tag == 'Event':  # New game.
+                self.accepted_type = True
+                self.elos = []
+                self.headers = []
+                self.link = None
+            elif tag == 'Variant':  # Don't want any variants.
+                self.accepted_type = False
+            elif tag == 'TimeControl':
+                self.time_type = downloader.time_control_type(value)
+                self.accepted_time = downloader.is_ok_game_type(self.time_type)
+            elif tag == 'WhiteElo' or tag == 'BlackElo':
+                self.elos.append(value)
+                if downloader.is_ok_elo(value):
+                    self.accepted_elo = True
+            elif tag == 'Link':  # e.g. 'https://www.chess.com/game/live/123', the same in both archives.
+                self.link = value
+            if self.dedup is not None:
+                self.headers.append(line)
+
+        elif self.accepted_time and self.accepted_elo and self.accepted_type and line.startswith('1.'):
+            stripped_pgn = downloader.delete_extra_parts_pgn(line)
+            if stripped_pgn != 'invalid':
+                opening_pgn = downloader.keep_only_opening(stripped_pgn)
+                if opening_pgn != '' and downloader.bucket_size:
+                    # Tagged like '@blitz_1500 e4 e5 ...' so the analyzer knows where to count it.
+                    bucket = downloader.game_bucket(self.time_type, self.elos)
+                    if bucket is None:
+                        opening_pgn = ''
+                    else:
+                        opening_pgn = '@' + bucket + ' ' + opening_pgn
+                if opening_pgn != '' and not self.is_duplicate(line):
+                    self.new_pgn.append(opening_pgn)
+            else:
                 print(line)
+            self.accepted_time = False
+            self.accepted_elo = False
 
-        all_pgns = ''.join(all_pgns)
+    def is_duplicate(self, line):
+        # Only games that would be kept get looked up, so the rest never take up room.
+        dedup = self.dedup
+        if dedup is None:
+            return False
+        # Without a link, the headers and the moves with their clocks are just as unique.
+        if dedup.seen(self.link if self.link is not None else '\n'.join(self.headers) + '\n' + line, self.new_keys):
+            self.downloader.metrics.inc('duplicate_games')
+            return True
+        return False
 
-        # Save.
-        with open(self.path_games + "\\" + 'all_pgns.pgn', 'w') as f:
-            f.write(all_pgns)
+    def stripped_pgn(self):
+        return '\n'.join(self.new_pgn)
+
+    def release(self):
+        if self.dedup is not None:
+            self.dedup.release(self.new_keys)
 
 
 class AnalyzePGNs(object):
-    def __init__(self, path_save):
+    # pgn_path can be '-' to read the games from stdin.
+    # san_cache_size is the max number of cached moves for read_pgn_fast. 0 uses read_pgn.
+    # checkpoint_every is in games. None turns checkpoints off.
+    # memory_budget (bytes) counts positions by their hash instead of their fen and writes sorted
+    # runs to disk whenever the counts get bigger than that. They're merged at the end.
+    # approx_threshold (e.g. 3) only gives a position its own counts once a count-min sketch has
+    # seen it that many times, so the rare ones that get pruned anyway never take up memory.
+    # Counts can be too high by the sketch's error_bound(), but nothing with enough games gets
+    # dropped. It only works with num_workers=1, since a position could be rare in every shard.
+    # partition is for one month of MonthlyStores: it starts over instead of adding to the stores
+    # that are there, prunes nothing and only writes the binary stores, since they just get merged.
+    def __init__(self, path_save, pgn_path=None, san_cache_size=200000, checkpoint_every=500000,
+                 memory_budget=None, approx_threshold=None, sketch_width=1 << 20, partition=False):
         self.path_save = path_save
-        self.fen_store_w = {}
-        self.fen_store_b = {}
+        if pgn_path is None:
+            pgn_path = os.path.join(self.path_save, 'all_pgns.pgn')
+        self.pgn_path = pgn_path
+        # Everything a worker process needs to make the same kind of analyzer.
+        self.options = {'path_save': path_save, 'pgn_path': pgn_path, 'san_cache_size': san_cache_size,
+                        'checkpoint_every': checkpoint_every, 'memory_budget': memory_budget,
+                        'approx_threshold': approx_threshold, 'sketch_width': sketch_width,
+                        'partition': partition}
+        self.partition = partition
+
+        self.chunk_size = 1 << 20
+        self.checkpoint_every = checkpoint_every
+        self.path_checkpoint = os.path.join(self.path_save, 'Checkpoint')
+
+        # Positions are either counted by board_fen in lists, or by hash in packed ints.
+        self.memory_budget = memory_budget
+        self.path_runs = os.path.join(self.path_checkpoint, 'Runs')
+        self.runs = {}  # bucket -> {'w': [run paths], 'b': [run paths]}
+        self.run_prefix = 'run'
+        self.stores_adopted = False  # The stores that were there are copied into the runs.
+        # bucket -> [white, black] of key -> [games, half points] that are in a binary store but
+        # not its json, so they still get written back out.
+        self.binary_extra = {}
+        if memory_budget:
+            self.position_id = zobrist_hasher.hash_board
+            self.add_to_fen_store = self.add_to_counter
+        else:
+            self.position_id = chess.BaseBoard.board_fen
+
+        self.approx_threshold = approx_threshold
+        if approx_threshold:
+            if memory_budget:  # Spilling empties the exact counts, so they'd be let in twice.
+                raise ValueError("approx_threshold can't be used with memory_budget.")
+            if partition:  # Rare in one month can still be common over the window.
+                raise ValueError("approx_threshold can't be used with partition.")
+            self.sketch_w = CountMinSketch(sketch_width)
+            self.sketch_b = CountMinSketch(sketch_width)
+            self.add_exact = self.add_to_fen_store
+            self.add_to_fen_store = self.add_to_fen_store_approx
+
+        # bucket -> [fen_store_w, fen_store_b, dirty_w, dirty_b]. '' is for games without a bucket
+        # tag. self.fen_store_w and the rest always point at the bucket being counted.
+        self.buckets = {}
+        self.use_bucket('')
+
+        # Replace with Metrics(path, 'analyze') to have them written out.
+        self.metrics = Metrics()
+        self.started = time.time()
+        self.start_offset = 0
+
+        # Trie of moves from the starting position: san -> (position_id, move, next node).
+        self.san_cache = {}
+        self.san_cache_size = san_cache_size
+        self.san_cache_used = 0
+        if san_cache_size > 0:
+            self.read_game = self.read_pgn_fast
+        else:
+            self.read_game = self.read_pgn
 
-    def analyzer(self, start_at=0):
-        self.open_all_pgns()
-        self.load_fen_store()
-        print("Opened pgns.")
+        # A move corpus made by encode_move_corpus is read record by record, without any SAN.
+        self.move_corpus = pgn_path.endswith('.mvs')
+        if self.move_corpus:
+            self.iter_games = self.iter_move_records
+            self.read_line = self.read_move_record
+        else:
+            self.iter_games = self.iter_pgn_lines
+
+    def use_bucket(self, bucket):
+        if bucket not in self.buckets:
+            # Positions changed since the last checkpoint, so only those get written.
+            if self.checkpoint_every and not self.memory_budget:
+                self.buckets[bucket] = [{}, {}, set(), set()]
+            else:
+                self.buckets[bucket] = [{}, {}, None, None]
+        self.bucket = bucket
+        self.fen_store_w, self.fen_store_b, self.dirty_w, self.dirty_b = self.buckets[bucket]
+
+    def bucket_path(self, bucket):
+        if bucket == '':
+            return self.path_save
+        return os.path.join(self.path_save, 'Buckets', bucket)
+
+    def read_line(self, i, pgn):
+        # Games from a bucketed download start with their bucket, e.g. '@blitz_1500 e4 e5 ...'.
+        if pgn.startswith('@'):
+            bucket, _, pgn = pgn[1:].partition(' ')
+            if bucket != self.bucket:
+                self.use_bucket(bucket)
+        elif self.bucket != '':
+            self.use_bucket('')
+
+        self.check_memory(i)
+        return self.read_game(i, pgn)
+
+    def check_memory(self, i):
+        if self.memory_budget and i % 1000 == 0 and self.counter_bytes() > self.memory_budget:
+            self.spill()
+
+    def analyzer(self, start_at=0, num_workers=1):
+        if not self.memory_budget and not self.partition:
+            self.load_fen_store()
+
+        if num_workers > 1:
+            self.parallel_analyzer(num_workers)
+        else:
+            print("Streaming pgns from", self.pgn_path)
+
+            # Picks up automatically after a crash.
+            checkpoint = self.load_checkpoint()
+            if checkpoint is not None and checkpoint.get('finishing'):
+                # Everything read is already in the checkpoint, so only the saving is left to do.
+                print("Finishing the run that crashed while saving.")
+                self.finish()
+                self.remove_checkpoint()
+                return
+            elif checkpoint is not None:
+                start_offset, first_game = checkpoint['offset'], checkpoint['games']
+                start_at = 0
+                print("Resuming from game", first_game, "at byte", start_offset)
+            else:
+                start_offset, first_game = 0, 0
+                self.remove_runs()  # From a run that crashed before its first checkpoint.
+
+            self.started = time.time()
+            self.start_offset = last_offset = start_offset
+            games_read = first_game
+            for i, (offset, pgn) in enumerate(self.iter_games(start_offset), first_game):
+                if i < start_at:
+                    continue
+                games_read = i + 1
+                with self.metrics.profiled('read_line'):
+                    positions = self.read_line(i, pgn)
+                self.metrics.inc('games')
+                self.metrics.inc('positions', positions or 0)
+                self.metrics.inc('bytes', offset - last_offset)
+                last_offset = offset
+                self.metrics.tick()
+                self.print_progress(i, offset)
+
+                if self.checkpoint_every and i % self.checkpoint_every == self.checkpoint_every - 1:
+                    self.save_checkpoint(offset, i + 1)
+
+            # Otherwise a crash while saving would count the games since the last checkpoint twice.
+            if self.checkpoint_every:
+                self.save_checkpoint(last_offset, games_read, finishing=True)
+
+        self.finish()
+        self.remove_checkpoint()
+
+    def finish(self):
+        if self.memory_budget:
+            self.merge_all_runs()
+        else:
+            self.save_all_stores()
+        self.metrics.flush()
+
+    def save_all_stores(self):
+        for bucket in sorted(self.buckets):
+            if bucket != '':
+                # Not pruned, since a position can be rare in every bucket but not once they're merged.
+                print("Saving bucket", bucket)
+                self.use_bucket(bucket)
+                os.makedirs(self.bucket_path(bucket), exist_ok=True)
+                if not self.partition:
+                    self.save_fen_store(self.bucket_path(bucket))
+                self.save_binary_store(self.bucket_path(bucket))
+
+        self.use_bucket('')
+        if self.partition:
+            if len(self.buckets) == 1 or self.fen_store_w:
+                print("Saving the month's binary stores.")
+                self.save_binary_store()
+        elif len(self.buckets) == 1 or self.fen_store_w:  # Only buckets, so nothing to save here.
+            if self.approx_threshold:
+                print("Count-min sketch error bound:", round(self.sketch_w.error_bound(), 3), "games for white,",
+                      round(self.sketch_b.error_bound(), 3), "for black.")
+            if '' in self.binary_extra:
+                self.fold_binary_extra()
+            print("Removing outliers for white.")
+            self.fen_store_w = self.remove_extra_stuff(self.fen_store_w)
+
+            print("Removing outliers for black.")
+            self.fen_store_b = self.remove_extra_stuff(self.fen_store_b)
+
+            print("Now saving to files.")
+            self.save_fen_store()
+            self.save_binary_store()
+            self.save_edge_index()
+
+    def counter_bytes(self):
+        return sum(len(stores[0]) + len(stores[1]) for stores in self.buckets.values()) * COUNTER_ENTRY_BYTES
+
+    def spill(self):
+        # Everything counted so far goes to disk as sorted runs and memory starts over.
+        os.makedirs(self.path_runs, exist_ok=True)
+        for bucket, stores in self.buckets.items():
+            for side, counts in zip(['w', 'b'], stores[:2]):
+                if not counts:
+                    continue
+                runs = self.runs.setdefault(bucket, {'w': [], 'b': []})[side]
+                run_path = os.path.join(self.path_runs, self.run_prefix + '_' + (bucket or 'all') + '_' +
+                                        side + '_' + str(len(runs)).zfill(5) + '.bin')
+                write_run(run_path, counts)
+                runs.append(run_path)
+                counts.clear()  # In place, since self.buckets and self.fen_store_w share it.
+        print(datetime.datetime.now(), "Spilled runs to disk.")
+
+    def add_runs(self, runs):
+        for bucket, bucket_runs in runs.items():
+            for side in ['w', 'b']:
+                self.runs.setdefault(bucket, {'w': [], 'b': []})[side].extend(bucket_runs[side])
+
+    def remove_runs(self):
+        if os.path.exists(self.path_runs):
+            shutil.rmtree(self.path_runs)
+        self.runs = {}
+
+    def adopt_stores(self):
+        # Adds to what's there, like load_fen_store. The stores get copied in as runs first, so
+        # merging again after a crash doesn't add the runs to a store that already has them.
+        if self.stores_adopted or self.partition:
+            return
+        os.makedirs(self.path_runs, exist_ok=True)
+        for bucket in sorted(self.runs):
+            for side, name in [('w', 'white'), ('b', 'black')]:
+                file_path = os.path.join(self.bucket_path(bucket), 'wins_per_opening_' + name + '_all.bin')
+                if os.path.exists(file_path):
+                    run_path = os.path.join(self.path_runs, self.run_prefix + '_' + (bucket or 'all') + '_' +
+                                            side + '_base.bin')
+                    shutil.copyfile(file_path, run_path)
+                    self.runs[bucket][side].insert(0, run_path)
+        self.stores_adopted = True
+
+    def merge_all_runs(self):
+        self.spill()
+        self.adopt_stores()
+        for bucket in sorted(self.runs):
+            path_bucket = self.bucket_path(bucket)
+            os.makedirs(path_bucket, exist_ok=True)
+            for side, name in [('w', 'white'), ('b', 'black')]:
+                file_path = os.path.join(path_bucket, 'wins_per_opening_' + name + '_all.bin')
+                runs = self.runs[bucket][side]
+                print("Merging", len(runs), "runs into", file_path)
+                # Buckets aren't pruned, like with save_all_stores.
+                merge_runs(runs, file_path, min_games=3 if bucket == '' and not self.partition else 1)
+
+        if '' in self.runs and not self.partition:
+            self.save_from_binary()
+
+    def save_from_binary(self):
+        # The jsons and the edge index need fens, so get them back from the hashes.
+        self.use_bucket('')
+        self.fen_store_w, self.fen_store_b = self.fen_stores_from_binary()
+        print("Now saving to files.")
+        self.save_fen_store()
+        self.save_edge_index()
+
+    def fen_stores_from_binary(self):
+        # Walks the legal moves from the start, only going into positions that are in the store.
+        # Every position of a game is counted at least as much as the ones after it, so a pruned
+        # store still has the way there (apart from some transpositions).
+        stores = {chess.WHITE: PositionStore(os.path.join(self.path_save, 'wins_per_opening_white_all.bin')),
+                  chess.BLACK: PositionStore(os.path.join(self.path_save, 'wins_per_opening_black_all.bin'))}
+        fen_stores = {chess.WHITE: {}, chess.BLACK: {}}
+
+        boards = [chess.Board()]
+        while boards:
+            next_boards = []
+            for board in boards:
+                store = stores[board.turn]
+                fen_store = fen_stores[board.turn]
+                for move in board.legal_moves:
+                    board.push(move)
+                    try:
+                        stats = store.get_by_hash(zobrist_hasher.hash_board(board))
+                    except KeyError:
+                        board.pop()
+                        continue
+                    fen = board.board_fen()
+                    if fen not in fen_store:
+                        fen_store[fen] = stats
+                        next_boards.append(board.copy(stack=False))
+                    board.pop()
+            boards = next_boards
+
+        return fen_stores[chess.WHITE], fen_stores[chess.BLACK]
+
+    def pgn_fingerprint(self):
+        # The first MB is enough to tell if it's a different file. Appending games is fine.
+        with open(self.pgn_path, 'rb') as f:
+            return hashlib.sha1(f.read(1 << 20)).hexdigest()
+
+    def save_checkpoint(self, offset, games, finishing=False):
+        if self.pgn_path == '-':  # Can't seek back into stdin.
+            return
+        os.makedirs(self.path_checkpoint, exist_ok=True)
+        manifest = self.read_checkpoint_manifest()
+        if manifest is None:
+            manifest = {'pgn_path': os.path.abspath(self.pgn_path),
+                        'fingerprint': self.pgn_fingerprint(), 'deltas': []}
+
+        if self.memory_budget:
+            # The runs already are the checkpoint, so the counts just get spilled early.
+            self.spill()
+            if finishing:
+                self.adopt_stores()
+            manifest['runs'] = self.runs
+            manifest['adopted'] = self.stores_adopted
+            manifest['offset'] = offset
+            manifest['games'] = games
+            manifest['finishing'] = finishing
+            write_json_atomic(os.path.join(self.path_checkpoint, 'checkpoint.json'), manifest)
+            print(datetime.datetime.now(), "Checkpoint saved at game", games)
+            return
 
-        for i, pgn in enumerate(self.all_pgns[start_at:]):
-            i += start_at
-            self.read_pgn(i, pgn)
+        if self.approx_threshold:
+            # Named after the delta, so an old manifest never points at a newer sketch.
+            sketch_name = 'sketch_' + str(len(manifest['deltas'])).zfill(5)
+            self.sketch_w.save(os.path.join(self.path_checkpoint, sketch_name + '_w.bin'))
+            self.sketch_b.save(os.path.join(self.path_checkpoint, sketch_name + '_b.bin'))
+            old_sketch = manifest.get('sketch')
+            manifest['sketch'] = sketch_name
+
+        # Only what changed since the last checkpoint, so it doesn't get slower as the store grows.
+        delta = {'buckets': {}}
+        for bucket, (fen_store_w, fen_store_b, dirty_w, dirty_b) in self.buckets.items():
+            bucket_delta = {'w': {fen: fen_store_w[fen] for fen in dirty_w},
+                            'b': {fen: fen_store_b[fen] for fen in dirty_b}}
+            if bucket == '':
+                delta.update(bucket_delta)
+            else:
+                delta['buckets'][bucket] = bucket_delta
+        delta_name = 'delta_' + str(len(manifest['deltas'])).zfill(5) + '.json'
+        write_json_atomic(os.path.join(self.path_checkpoint, delta_name), delta)
+
+        # The delta only counts once the manifest points at it.
+        manifest['deltas'].append(delta_name)
+        manifest['offset'] = offset
+        manifest['games'] = games
+        manifest['finishing'] = finishing
+        write_json_atomic(os.path.join(self.path_checkpoint, 'checkpoint.json'), manifest)
+
+        if self.approx_threshold and old_sketch is not None:
+            os.remove(os.path.join(self.path_checkpoint, old_sketch + '_w.bin'))
+            os.remove(os.path.join(self.path_checkpoint, old_sketch + '_b.bin'))
+
+        for fen_store_w, fen_store_b, dirty_w, dirty_b in self.buckets.values():
+            dirty_w.clear()
+            dirty_b.clear()
+        print(datetime.datetime.now(), "Checkpoint saved at game", games)
+
+    def read_checkpoint_manifest(self):
+        try:
+            with open(os.path.join(self.path_checkpoint, 'checkpoint.json'), 'r') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
 
-        print("Removing outliers for white.")
-        self.fen_store_w = self.remove_extra_stuff(self.fen_store_w)
+    def load_checkpoint(self):
+        if not self.checkpoint_every or self.pgn_path == '-':
+            return None
+        manifest = self.read_checkpoint_manifest()
+        if manifest is None:
+            return None
 
-        print("Removing outliers for black.")
-        self.fen_store_b = self.remove_extra_stuff(self.fen_store_b)
+        if manifest['pgn_path'] != os.path.abspath(self.pgn_path) or manifest['fingerprint'] != self.pgn_fingerprint():
+            print("Checkpoint is for a different pgn file. Starting over.")
+            self.remove_checkpoint()
+            return None
 
-        print("Now saving to files.")
-        self.save_fen_store()
+        self.runs = manifest.get('runs', {})
+        self.stores_adopted = manifest.get('adopted', False)
+        if self.approx_threshold and 'sketch' in manifest:
+            self.sketch_w.load(os.path.join(self.path_checkpoint, manifest['sketch'] + '_w.bin'))
+            self.sketch_b.load(os.path.join(self.path_checkpoint, manifest['sketch'] + '_b.bin'))
+
+        # Each delta has the full counts of the positions it touched, so later ones win.
+        for delta_name in manifest['deltas']:
+            with open(os.path.join(self.path_checkpoint, delta_name), 'r') as f:
+                delta = json.load(f)
+            self.use_bucket('')
+            self.fen_store_w.update(delta['w'])
+            self.fen_store_b.update(delta['b'])
+            for bucket, bucket_delta in delta.get('buckets', {}).items():
+                self.use_bucket(bucket)
+                self.fen_store_w.update(bucket_delta['w'])
+                self.fen_store_b.update(bucket_delta['b'])
+
+        self.use_bucket('')
+        return manifest
+
+    def remove_checkpoint(self):
+        if os.path.exists(self.path_checkpoint):
+            shutil.rmtree(self.path_checkpoint)
+
+    def parallel_analyzer(self, num_workers):
+        # More shards than workers so one slow shard doesn't hold everyone up.
+        shards = self.find_shards(num_workers * 4)
+        print("Analyzing", len(shards), "shards with", num_workers, "workers.")
+
+        options = self.worker_options(num_workers)
+        executor = concurrent.futures.ProcessPoolExecutor(max_workers=num_workers)
+        futures = [executor.submit(analyze_shard, options, start, end)
+                   for start, end in shards]
+
+        # Merge in shard order so the stores come out exactly like the serial ones.
+        for shard_num, future in enumerate(futures):
+            self.add_worker_result(future.result())
+            print(datetime.datetime.now(), "Merged shard", shard_num)
+            self.metrics.inc('shards')
+            self.metrics.inc('bytes', shards[shard_num][1] - shards[shard_num][0])
+            self.metrics.tick()
+        self.use_bucket('')
+
+        executor.shutdown(wait=True)
+
+    def worker_options(self, num_workers):
+        options = dict(self.options)
+        if self.approx_threshold:
+            print("approx_threshold only works with one worker, so the shards count exactly.")
+            options['approx_threshold'] = None
+        if self.memory_budget:
+            # Each worker spills its own runs, so they share the budget.
+            options['memory_budget'] = max(self.memory_budget // num_workers, 1)
+            self.remove_runs()
+        return options
+
+    def worker_result(self):
+        # What a worker process sends back: only the run paths with memory_budget, otherwise the counts.
+        if self.memory_budget:
+            self.spill()
+            return self.runs
+        return {bucket: stores[:2] for bucket, stores in self.buckets.items()}
+
+    def add_worker_result(self, result):
+        if self.memory_budget:
+            self.add_runs(result)
+        else:
+            for bucket, (fen_store_w, fen_store_b) in result.items():
+                self.use_bucket(bucket)
+                self.merge_fen_store(self.fen_store_w, fen_store_w)
+                self.merge_fen_store(self.fen_store_b, fen_store_b)
+        self.use_bucket('')
+
+    def find_shards(self, num_shards):
+        if self.pgn_path == '-' or self.pgn_path.endswith('.gz'):
+            raise ValueError("Can't split stdin or a .gz file into shards. Use num_workers=1.")
+        file_size = os.path.getsize(self.pgn_path)
+
+        if self.move_corpus:  # Fixed size records, so the cuts can just be counted.
+            num_records = (file_size - MOVES_HEADER.size) // MOVE_RECORD.size
+            cuts = [MOVES_HEADER.size + num_records * shard_num // num_shards * MOVE_RECORD.size
+                    for shard_num in range(num_shards + 1)]
+            return [(start, end) for start, end in zip(cuts[:-1], cuts[1:]) if end > start]
+
+        # Move every cut forward to the start of the next line so no game gets split.
+        cuts = [0]
+        with open(self.pgn_path, 'rb') as f:
+            for shard_num in range(1, num_shards):
+                f.seek(max(file_size * shard_num // num_shards, cuts[-1]))
+                if f.tell() > 0:
+                    f.seek(f.tell() - 1)
+                    f.readline()
+                cuts.append(f.tell())
+        cuts.append(file_size)
+
+        return [(start, end) for start, end in zip(cuts[:-1], cuts[1:]) if end > start]
+
+    def analyze_dump(self, dump_path, filters, num_workers=1, keep_path=None):
+        # A whole dump, decompressed and stripped by strip_dump in its own process while this one
+        # (or num_workers others) counts. Nothing to seek back into, so no checkpoints.
+        if not self.memory_budget and not self.partition:
+            self.load_fen_store()
+        num_counters = max(num_workers, 1)
+        # A manager's queue can be handed to pool workers. A few batches each is enough to never wait.
+        manager = multiprocessing.Manager()
+        game_queue = manager.Queue(maxsize=num_counters * 4)
+        reader = multiprocessing.Process(target=strip_dump, args=(filters, dump_path, game_queue, num_counters, keep_path))
+        reader.start()
+        print("Ingesting", dump_path, "with", num_counters, "counting processes.")
 
-    def open_all_pgns(self):
-        with open(os.path.join(self.path_save, 'all_pgns.pgn'), 'r') as f:
-            self.all_pgns = f.readlines()
+        try:
+            if num_workers > 1:
+                options = self.worker_options(num_workers)
+                executor = concurrent.futures.ProcessPoolExecutor(max_workers=num_workers)
+                futures = [executor.submit(count_stream, options, game_queue, dump_path) for _ in range(num_workers)]
+                for worker_num, future in enumerate(futures):
+                    self.add_worker_result(future.result())
+                    print(datetime.datetime.now(), "Merged worker", worker_num)
+                executor.shutdown(wait=True)
+            else:
+                if self.memory_budget:
+                    self.remove_runs()
+                self.read_stream(game_queue, dump_path)
+        finally:
+            reader.join()
+            manager.shutdown()
+        self.finish()
+        self.remove_checkpoint()  # Where the runs were spilled.
+
+    def read_stream(self, game_queue, dump_path):
+        # Batches of (bytes of the dump read, games) from strip_dump, until it sends None.
+        self.started = time.time()
+        self.start_offset = 0
+        dump_size = os.path.getsize(dump_path)
+        i = 0
+        last_offset = 0
+        while True:
+            item = game_queue.get()
+            if item is None:
+                return i
+            if isinstance(item, str):
+                raise RuntimeError("Couldn't read " + dump_path + ":\n" + item)
+
+            offset, games = item
+            for pgn in games:
+                with self.metrics.profiled('read_line'):
+                    positions = self.read_line(i, pgn)
+                self.metrics.inc('games')
+                self.metrics.inc('positions', positions or 0)
+                self.metrics.tick()
+                self.print_progress(i, offset, dump_size)
+                i += 1
+            self.metrics.inc('bytes', offset - last_offset)
+            last_offset = offset
+
+    def read_shard(self, start, end):
+        self.started = time.time()
+        self.start_offset = start
+        for i, (offset, pgn) in enumerate(self.iter_games(start, end)):
+            self.read_line(i, pgn)
+            self.print_progress(i, offset)
+
+    def merge_fen_store(self, fen_store, partial_fen_store):
+        for fen, stats in partial_fen_store.items():
+            try:
+                fen_store[fen][0] += stats[0]
+                fen_store[fen][1] += stats[1]
+            except KeyError:
+                fen_store[fen] = stats
+
+    def iter_pgn_lines(self, start=0, end=None):
+        # Yields (byte offset after the line, line) reading fixed size chunks, so memory
+        # doesn't grow with the size of the file.
+        if self.pgn_path == '-':
+            f = sys.stdin.buffer
+        elif self.pgn_path.endswith('.gz'):  # Offsets are in the uncompressed text.
+            f = gzip.open(self.pgn_path, 'rb')
+            f.seek(start)
+        else:
+            f = open(self.pgn_path, 'rb')
+            f.seek(start)
+
+        try:
+            offset = start
+            leftover = b''
+            while end is None or offset < end:
+                chunk = f.read(self.chunk_size)
+                if not chunk:
+                    break
+                lines = (leftover + chunk).split(b'\n')
+                leftover = lines.pop()
+
+                for line in lines:
+                    offset += len(line) + 1
+                    # Same as reading in text mode, every line keeps its '\n'.
+                    yield offset, line.rstrip(b'\r').decode() + '\n'
+                    if end is not None and offset >= end:
+                        return
+
+            if leftover and (end is None or offset < end):
+                yield offset + len(leftover), leftover.decode()
+        finally:
+            if f is not sys.stdin.buffer:
+                f.close()
+
+    def iter_move_records(self, start=0, end=None):
+        # Same as iter_pgn_lines, but yields (byte offset after the record, record). Reads through an
+        # mmap, so the OS does the buffering.
+        with open(self.pgn_path, 'rb') as f:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            magic, version, record_size = MOVES_HEADER.unpack_from(mm)
+            if magic != MOVES_MAGIC or version != MOVES_VERSION or record_size != MOVE_RECORD.size:
+                raise ValueError("Not a move corpus: " + self.pgn_path)
+
+            offset = max(start, MOVES_HEADER.size)
+            if end is None:
+                end = len(mm)
+            while offset + MOVE_RECORD.size <= end:
+                yield offset + MOVE_RECORD.size, mm[offset:offset + MOVE_RECORD.size]
+                offset += MOVE_RECORD.size
+        finally:
+            mm.close()
+
+    def read_move_record(self, i, record):
+        # read_pgn_fast for a move corpus. The trie is the same one, with move codes instead of SANs.
+        moves, plies, result, time_type, by_index, band = MOVE_RECORD.unpack(record)
+        bucket = MOVE_TIME_TYPES[time_type] + '_' + str(band) if time_type else ''
+        if bucket != self.bucket:
+            self.use_bucket(bucket)
+        self.check_memory(i)
+        winner_w, winner_b = MOVE_WINNERS[result]
+
+        node = self.san_cache
+        if by_index:  # Codes mean something else, so those games get their own branch.
+            node = node.setdefault('by_index', {})
+        known_moves = []
+        board = None
+        for ply in range(plies):
+            try:
+                fen, parsed_move, node = node[moves[ply]]
+                known_moves.append(parsed_move)
+            except KeyError:
+                if board is None:  # First miss, so get the board up to here.
+                    board = chess.Board()
+                    for known_move in known_moves:
+                        board.push(known_move)
+                if by_index:
+                    parsed_move = sorted_legal_moves(board)[moves[ply]]
+                else:
+                    parsed_move = decode_move(board, moves[ply])
+                board.push(parsed_move)
+
+                fen = self.position_id(board)
+                new_node = {}
+                if self.san_cache_used < self.san_cache_size:
+                    node[moves[ply]] = (fen, parsed_move, new_node)
+                    self.san_cache_used += 1
+                node = new_node
+
+            if ply % 2 == 0:  # White just moved.
+                self.add_to_fen_store(fen, winner_w, 'w')
+            else:
+                self.add_to_fen_store(fen, winner_b, 'b')
+
+        return plies
+
+    def encode_move_corpus(self, corpus_path):
+        # Turns the text games at pgn_path into a move corpus (.mvs), so later analyses skip the SAN.
+        # Games past MOVE_RECORD_PLIES get cut there.
+        num_games = 0
+        with open(corpus_path + '.tmp', 'wb') as f:
+            f.write(MOVES_HEADER.pack(MOVES_MAGIC, MOVES_VERSION, MOVE_RECORD.size))
+            for i, (offset, pgn) in enumerate(self.iter_pgn_lines()):
+                time_type, band = 0, 0
+                if pgn.startswith('@'):
+                    bucket, _, pgn = pgn[1:].partition(' ')
+                    game_type, _, band = bucket.rpartition('_')
+                    time_type, band = MOVE_TIME_TYPES.index(game_type), int(band)
+
+                tokens = pgn.split()
+                if not tokens or tokens[-1] not in MOVE_RESULTS:
+                    print("Error in game result:", i)
+                    continue
+
+                board = chess.Board()
+                moves = bytearray()
+                by_index = 0
+                try:
+                    for move in tokens[:-1]:
+                        if move.endswith('.'):  # Move numbers.
+                            continue
+                        if len(moves) == MOVE_RECORD_PLIES:
+                            break
+                        parsed_move = board.parse_san(move)
+                        code = encode_move(board, parsed_move)
+                        if code is None:
+                            by_index = 1
+                        moves.append(code or 0)
+                        board.push(parsed_move)
+                except ValueError:  # Probably is a variant where the move is illegal.
+                    print("Error pushing move:", i, move, board.fen())
+                    continue
+
+                if by_index:  # Rare, so the moves are only done again for these.
+                    parsed_moves = board.move_stack
+                    board = chess.Board()
+                    for ply, parsed_move in enumerate(parsed_moves):
+                        moves[ply] = sorted_legal_moves(board).index(parsed_move)
+                        board.push(parsed_move)
+
+                plies = len(moves)
+                moves.extend(b'\xff' * (MOVE_RECORD_PLIES - plies))
+                f.write(MOVE_RECORD.pack(bytes(moves), plies, MOVE_RESULTS[tokens[-1]], time_type, by_index, band))
+                num_games += 1
+                self.print_progress(i, offset)
+        os.replace(corpus_path + '.tmp', corpus_path)
+
+        print(num_games, "games encoded into", corpus_path)
+        return num_games
+
+    def print_progress(self, i, offset, file_size=None):
+        # file_size is for offsets into something other than pgn_path, like a compressed dump.
+        if i % 1000 == 0:
+            # 11.3 Million games takes about 10 hours.
+            bytes_per_sec = (offset - self.start_offset) / max(time.time() - self.started, 1e-9)
+            if file_size is None and (self.pgn_path == '-' or self.pgn_path.endswith('.gz')):
+                print(datetime.datetime.now(), i, offset, "bytes", round(bytes_per_sec / 1e6, 2), "MB/sec")
+            else:
+                file_size = max(file_size or os.path.getsize(self.pgn_path), 1)
+                eta = (file_size - offset) / max(bytes_per_sec, 1e-9)
+                self.metrics.set('eta_seconds', eta)
+                print(datetime.datetime.now(), i, offset, "bytes", str(
+                    round(offset / file_size * 100, 2)) + "%", round(bytes_per_sec / 1e6, 2), "MB/sec",
+                    "ETA", datetime.timedelta(seconds=round(eta)))
 
     def load_fen_store(self):
-        if not os.path.exists(os.path.join(self.path_save, 'wins_per_opening_white_all.json')):
-            print("Wins per opening doesn't exist yet. That's ok.")
-            return
-        with open(os.path.join(self.path_save, 'wins_per_opening_white_all.json'), 'r') as f:
-            self.fen_store_w = json.load(f)
-        with open(os.path.join(self.path_save, 'wins_per_opening_black_all.json'), 'r') as f:
-            self.fen_store_b = json.load(f)
+        buckets = ['']
+        if os.path.exists(os.path.join(self.path_save, 'Buckets')):
+            buckets += sorted(os.listdir(os.path.join(self.path_save, 'Buckets')))
+
+        for bucket in buckets:
+            path_bucket = self.bucket_path(bucket)
+            if not os.path.exists(os.path.join(path_bucket, 'wins_per_opening_white_all.json')) and \
+                    not os.path.exists(os.path.join(path_bucket, 'wins_per_opening_white_all.bin')):
+                if bucket == '':
+                    print("Wins per opening doesn't exist yet. That's ok.")
+                continue
+            self.use_bucket(bucket)
+            extra_w = self.load_store_pair(os.path.join(path_bucket, 'wins_per_opening_white_all'), self.fen_store_w)
+            extra_b = self.load_store_pair(os.path.join(path_bucket, 'wins_per_opening_black_all'), self.fen_store_b)
+            if extra_w or extra_b:
+                self.binary_extra[bucket] = [extra_w, extra_b]
+
+        self.use_bucket('')
+
+    def fold_binary_extra(self):
+        # Positions that only had a hash get their fen back once a game reaches them, so they
+        # don't get pruned on just the new games.
+        for fen_store, extra in zip([self.fen_store_w, self.fen_store_b], self.binary_extra['']):
+            for fen, stats in fen_store.items():
+                extra_stats = extra.pop(position_hash(fen), None)
+                if extra_stats is not None:
+                    fen_store[fen] = [stats[0] + extra_stats[0], stats[1] + extra_stats[1] / 2]
+
+    def load_store_pair(self, file_path, fen_store):
+        # The json, unless the binary store has more in it (memory_budget only writes the fens it
+        # could get back, and only the binary store for buckets). Then the counts come from the
+        # binary store, and what isn't in the json is returned by hash so it still gets saved.
+        if os.path.exists(file_path + '.json'):
+            with open(file_path + '.json', 'r') as f:
+                fen_store.update(json.load(f))
+        if not os.path.exists(file_path + '.bin'):
+            return {}
+
+        store = PositionStore(file_path + '.bin')
+        if len(store) == len(fen_store) and sum(store.games) == sum(int(stats[0]) for stats in fen_store.values()):
+            return {}
+        print("Taking the counts from", file_path + '.bin', "since the json doesn't have all of them.")
+        extra = {key: [games, half_points] for key, games, half_points in zip(store.keys, store.games, store.half_points)}
+        for fen in list(fen_store):
+            stats = extra.pop(position_hash(fen), None)
+            if stats is None:
+                del fen_store[fen]
+            else:
+                fen_store[fen] = [stats[0], stats[1] / 2]
+        return extra
 
     def game_result(self, pgn, colour):
         game_result = pgn[-4:-1]
@@ -349,7 +2187,7 @@ class AnalyzePGNs(object):
 
             move_num += 0.5
             # Saves a lot of time copared to board.fen() and we don't need the extra.
-            fen = board.board_fen()
+            fen = self.position_id(board)
 
             # Not something.5 means it's white.
             if int(str(move_num)[-1]) != 5:
@@ -357,27 +2195,98 @@ class AnalyzePGNs(object):
             else:  # It's black's turn.
                 self.add_to_fen_store(fen, winner_b, 'b')
 
-        if i % 1000 == 0:
-            # 11.3 Million games takes about 10 hours.
-            print(datetime.datetime.now(), i)
-        if i % 500000 == 499999:
-            print("Saving just in case.")
-            self.save_fen_store()  # Just in case.
+        return len(board.move_stack)  # Positions counted.
+
+    def read_pgn_fast(self, i, pgn):
+        # Same counts as read_pgn, but openings share their first moves so most of them are
+        # already in self.san_cache and python-chess is only needed for the rest.
+        winner_w = self.game_result(pgn, 'w')
+        winner_b = self.game_result(pgn, 'b')
+        if winner_w is None or winner_b is None:
+            return
+
+        # Last one is the result. Move numbers (e.g. '1.') and NAGs (e.g. '$1') are skipped if
+        # there are any.
+        moves = [move for move in pgn.split()[:-1] if not move.endswith('.') and move[0] != '$']
+
+        node = self.san_cache
+        known_moves = []
+        board = None
+        for ply, move in enumerate(moves):
+            try:
+                fen, parsed_move, node = node[move]
+                known_moves.append(parsed_move)
+            except KeyError:
+                if board is None:  # First miss, so get the board up to here.
+                    board = chess.Board()
+                    for known_move in known_moves:
+                        board.push(known_move)
+                try:
+                    # Annotations (e.g. 'b5?!') are fine for chess.pgn but not parse_san. The
+                    # cache still has them under the whole token, so they're only stripped once.
+                    parsed_move = board.push_san(move.rstrip('?!'))
+                except ValueError:  # Probably is a variant where the move is illegal.
+                    print("Error pushing move:", i, move, board.fen())
+                    return
+
+                fen = self.position_id(board)
+                new_node = {}
+                if self.san_cache_used < self.san_cache_size:
+                    node[move] = (fen, parsed_move, new_node)
+                    self.san_cache_used += 1
+                node = new_node
+
+            if ply % 2 == 0:  # White just moved.
+                self.add_to_fen_store(fen, winner_w, 'w')
+            else:
+                self.add_to_fen_store(fen, winner_b, 'b')
+
+        return len(moves)  # Positions counted.
 
     def add_to_fen_store(self, fen, winner, side):
         if side == 'w':
+            if self.dirty_w is not None:
+                self.dirty_w.add(fen)
             try:
                 self.fen_store_w[fen][0] += 1
                 self.fen_store_w[fen][1] += winner
             except KeyError:
                 self.fen_store_w[fen] = [1, winner]
         else:
+            if self.dirty_b is not None:
+                self.dirty_b.add(fen)
             try:
                 self.fen_store_b[fen][0] += 1
                 self.fen_store_b[fen][1] += winner
             except KeyError:
                 self.fen_store_b[fen] = [1, winner]
 
+    def add_to_fen_store_approx(self, fen, winner, side):
+        # Buckets aren't pruned, so they always count exactly.
+        if self.bucket != '':
+            return self.add_exact(fen, winner, side)
+
+        if side == 'w':
+            fen_store, sketch, dirty = self.fen_store_w, self.sketch_w, self.dirty_w
+        else:
+            fen_store, sketch, dirty = self.fen_store_b, self.sketch_b, self.dirty_b
+        if fen in fen_store:
+            return self.add_exact(fen, winner, side)
+
+        packed = sketch.add(sketch_key(fen), PACKED_RESULT[winner])
+        if packed & 0xFFFFFFFF >= self.approx_threshold:
+            # Starts from what the sketch has, this game included, so nothing before it is lost.
+            fen_store[fen] = [packed & 0xFFFFFFFF, (packed >> 32) / 2]
+            if dirty is not None:
+                dirty.add(fen)
+
+    def add_to_counter(self, key, winner, side):
+        # add_to_fen_store for memory_budget, where the fen is a hash.
+        if side == 'w':
+            self.fen_store_w[key] = self.fen_store_w.get(key, 0) + PACKED_RESULT[winner]
+        else:
+            self.fen_store_b[key] = self.fen_store_b.get(key, 0) + PACKED_RESULT[winner]
+
     def remove_extra_stuff(self, fen_store):
         new_fen_store = {}
         for fen in fen_store.keys():
@@ -386,59 +2295,613 @@ class AnalyzePGNs(object):
 
         return new_fen_store
 
-    def save_fen_store(self):
-        with open(os.path.join(self.path_save, "wins_per_opening_white_all.json"), "w") as f:
-            json.dump(self.fen_store_w, f,
-                      indent=4, default=str)
+    def save_fen_store(self, path_save=None):
+        if path_save is None:
+            path_save = self.path_save
+        os.makedirs(path_save, exist_ok=True)
+        write_json_atomic(os.path.join(
+            path_save, "wins_per_opening_white_all.json"), self.fen_store_w, indent=4)
+        write_json_atomic(os.path.join(
+            path_save, "wins_per_opening_black_all.json"), self.fen_store_b, indent=4)
+
+    def ranked_children(self, parent_fens, fen_store, turn):
+        # parent -> [[san, child, games, score], ...] best score ratio first. Move generation
+        # happens once here instead of on every query.
+        index = {}
+        for parent in parent_fens:
+            # Castling rights aren't in a board_fen. python-chess drops the ones that can't be right
+            # and SearchOpenings checks the rest against the real board.
+            board = chess.Board(parent + ' ' + turn + ' KQkq - 0 1')
+            ranked = []
+            for move in board.legal_moves:
+                board.push(move)
+                child = board.board_fen()
+                board.pop()
+                if child in fen_store:
+                    ranked.append([board.san(move), child, fen_store[child][0], fen_store[child][1]])
+
+            if ranked:
+                ranked.sort(key=lambda item: item[3]/item[2], reverse=True)
+                index[parent] = ranked
+        return index
+
+    def save_edge_index(self):
+        # White moves from the start and from every position black moved into, and the other way around.
+        edges_w = self.ranked_children([chess.STARTING_BOARD_FEN] + list(self.fen_store_b), self.fen_store_w, 'w')
+        edges_b = self.ranked_children(list(self.fen_store_w), self.fen_store_b, 'b')
+        self.save_ply_shards(edges_w, edges_b)
+        # Only the shards are read when they're there, so a whole index from before them would just go stale.
+        for name in ['white', 'black']:
+            edges_path = os.path.join(self.path_save, "edges_per_opening_" + name + "_all.json")
+            if os.path.exists(edges_path):
+                os.remove(edges_path)
+
+    def save_ply_shards(self, edges_w, edges_b):
+        # The edge index again, split by the fewest plies it takes to get to each parent from the
+        # start, so SearchOpenings only loads as deep as a session goes. Parents the index can't get
+        # to from the start go in the rest shard.
+        plies = [{chess.STARTING_BOARD_FEN: 0}, {}]  # White to move, black to move.
+        parents = [chess.STARTING_BOARD_FEN]
+        ply = 0
+        while parents:
+            edges = edges_w if ply % 2 == 0 else edges_b
+            next_plies = plies[(ply + 1) % 2]
+            next_parents = []
+            for parent in parents:
+                for san, child, games, wins in edges.get(parent, []):
+                    if child not in next_plies:
+                        next_plies[child] = ply + 1
+                        next_parents.append(child)
+            parents = next_parents
+            ply += 1
+
+        path_plies = os.path.join(self.path_save, 'Plies')
+        if os.path.exists(path_plies):  # Shards from a deeper store would be left over.
+            shutil.rmtree(path_plies)
+        os.makedirs(path_plies)
+        for name, edges, parent_plies in [('white', edges_w, plies[0]), ('black', edges_b, plies[1])]:
+            shards = {'rest': {}}
+            for parent, ranked in edges.items():
+                shard = str(parent_plies[parent]).zfill(2) if parent in parent_plies else 'rest'
+                shards.setdefault(shard, {})[parent] = ranked
+            for shard, shard_edges in shards.items():
+                write_json_atomic(os.path.join(path_plies, 'edges_' + name + '_' + shard + '.json'), shard_edges)
+
+    def save_binary_store(self, path_save=None):
+        if path_save is None:
+            path_save = self.path_save
+        extra_w, extra_b = self.binary_extra.get(self.bucket, [None, None])
+        write_binary_store(os.path.join(
+            path_save, "wins_per_opening_white_all.bin"), self.fen_store_w, extra_w)
+        write_binary_store(os.path.join(
+            path_save, "wins_per_opening_black_all.bin"), self.fen_store_b, extra_b)
+
+    def convert_to_binary_store(self):  # For jsons made before the binary store existed.
+        self.load_fen_store()
+        self.save_binary_store()
+        self.save_edge_index()
+
+
+def analyze_shard(options, start, end):
+    # Runs in a worker process, so it starts from empty stores. Only the main process checkpoints.
+    shard_analyzer = AnalyzePGNs(**dict(options, checkpoint_every=None))
+    shard_analyzer.run_prefix = 'shard' + str(start)
+    shard_analyzer.read_shard(start, end)
+    return shard_analyzer.worker_result()
+
+
+def count_stream(options, game_queue, dump_path):
+    # analyze_shard for analyze_dump: the games come from strip_dump instead of part of a file.
+    stream_analyzer = AnalyzePGNs(**dict(options, checkpoint_every=None))
+    stream_analyzer.run_prefix = 'stream' + str(os.getpid())
+    stream_analyzer.read_stream(game_queue, dump_path)
+    return stream_analyzer.worker_result()
+
+
+def open_dump(dump_path):
+    # Lines of a pgn dump, decompressed while they're read. The raw file's position is how far
+    # into the dump it is.
+    raw_file = open(dump_path, 'rb')
+    if dump_path.endswith('.gz'):
+        stream = gzip.GzipFile(fileobj=raw_file)
+    elif dump_path.endswith('.bz2'):
+        stream = bz2.BZ2File(raw_file)
+    elif dump_path.endswith('.zst'):
+        if zstandard is None:
+            raise ImportError("Reading .zst dumps needs zstandard (pip install zstandard).")
+        # Big dumps can be made with a long window (zstd --long).
+        stream = zstandard.ZstdDecompressor(max_window_size=1 << 31).stream_reader(raw_file)
+    else:
+        stream = raw_file
+    return raw_file, io.TextIOWrapper(stream, encoding='utf-8', errors='replace')
+
+
+def send_games(game_queue, offset, games, keep_file=None):
+    # Lines end with a newline, just like the ones from iter_pgn_lines.
+    games = [pgn + '\n' for pgn in games]
+    if keep_file is not None:  # To analyze again later without the dump.
+        keep_file.write(''.join(games))
+    game_queue.put((offset, games))
+
+
+def strip_dump(filters, dump_path, game_queue, num_counters=1, keep_path=None, batch_size=1000):
+    # Runs in its own process. The same rules as strip_user_pgn, with filters being DownloadPGNs'
+    # arguments. Every counting process gets a None at the end, or the error if there was one.
+    try:
+        downloader = DownloadPGNs(**dict(filters, dedup_capacity=None))
+        if filters.get('dedup_capacity'):  # Dumps usually have every game once.
+            path_dedup = os.path.join(filters['path_save'], 'Ingest Dedup')
+            if os.path.exists(path_dedup):
+                shutil.rmtree(path_dedup)
+            downloader.dedup = GameDeduplicator(path_dedup, filters['dedup_capacity'])
+        stripper = PGNStripper(downloader)
+
+        raw_file, dump_file = open_dump(dump_path)
+        keep_file = open(keep_path, 'a', buffering=1 << 20) if keep_path else None
+        with raw_file, dump_file:
+            for line in dump_file:
+                stripper.feed(line.rstrip('\r\n'))
+                if len(stripper.new_pgn) >= batch_size:
+                    send_games(game_queue, raw_file.tell(), stripper.new_pgn, keep_file)
+                    stripper.new_pgn = []
+            send_games(game_queue, raw_file.tell(), stripper.new_pgn, keep_file)
+
+        if keep_file is not None:
+            keep_file.close()
+        if downloader.dedup is not None:
+            print("Dropped", downloader.dedup.duplicates, "duplicate games out of", downloader.dedup.games)
+        end = None
+    except Exception:
+        end = traceback.format_exc()
+
+    for _ in range(num_counters):
+        game_queue.put(end)
+
+
+def ingest_dump(dump_path, elo_from, elo_to, path_save, game_type='blitz', bucket_size=None, num_workers=1,
+                keep_path=None, dedup_capacity=None, **analyzer_options):
+    # Offline instead of download_usernames and download_games: a monthly dump (e.g. from
+    # database.lichess.org, plain, .gz, .bz2 or .zst) goes straight into the stores in path_save.
+    # keep_path also appends the stripped games there, for encode_move_corpus or another analysis.
+    filters = {'elo_from': elo_from, 'elo_to': elo_to, 'path_save': path_save, 'game_type': game_type,
+               'bucket_size': bucket_size, 'dedup_capacity': dedup_capacity}
+    analyzer = AnalyzePGNs(path_save, dump_path, checkpoint_every=None, **analyzer_options)
+    analyzer.metrics = Metrics(os.path.join(path_save, 'Metrics'), 'ingest')
+    analyzer.analyze_dump(dump_path, filters, num_workers, keep_path)
+    return analyzer
+
+
+class MonthlyStores(object):
+    # One partial store per month in Months/<YYYY-MM>, made with AnalyzePGNs(partition=True). The
+    # store SearchOpenings uses is a window of months added together, so a refresh only analyzes
+    # the new month instead of every month again.
+    def __init__(self, path_save, min_games=3):
+        self.path_save = path_save
+        self.path_months = os.path.join(path_save, 'Months')
+        self.min_games = min_games
+
+    def month_path(self, month):
+        return os.path.join(self.path_months, month)
+
+    def bucket_path(self, path_store, bucket):
+        # Same layout as AnalyzePGNs.bucket_path, for a month or a window.
+        if bucket == '':
+            return path_store
+        return os.path.join(path_store, 'Buckets', bucket)
+
+    def months(self):
+        # Months that finished analyzing, oldest first. 'YYYY-MM' sorts by date.
+        if not os.path.exists(self.path_months):
+            return []
+        return sorted(month for month in os.listdir(self.path_months)
+                      if os.path.exists(os.path.join(self.month_path(month), 'month.json')))
+
+    def analyze_month(self, month, pgn_path=None, num_workers=1, **options):
+        # Same options as AnalyzePGNs. pgn_path defaults to where DownloadPGNs(by_month=True) puts it.
+        if pgn_path is None:
+            pgn_path = os.path.join(self.month_path(month), 'all_pgns.pgn')
+        print("Analyzing month", month)
+
+        path_month = self.month_path(month)
+        if os.path.exists(os.path.join(path_month, 'month.json')):  # Analyzed again from scratch.
+            os.remove(os.path.join(path_month, 'month.json'))
+        if os.path.exists(os.path.join(path_month, 'Buckets')):
+            shutil.rmtree(os.path.join(path_month, 'Buckets'))
+
+        AnalyzePGNs(path_month, pgn_path, partition=True, **options).analyzer(num_workers=num_workers)
+        # Only counts once it's there, so a crashed month never ends up in a window.
+        write_json_atomic(os.path.join(path_month, 'month.json'),
+                          {'month': month, 'pgn_path': os.path.abspath(pgn_path),
+                           'analyzed': datetime.datetime.now().isoformat()})
+
+    def merge_window(self, months=None, path_save=None):
+        # Adds up the months' binary stores into path_save (the normal store by default). They're
+        # only pruned here, once every month is in. An old window can go somewhere else to compare.
+        if months is None:
+            months = self.months()
+        if path_save is None:
+            path_save = self.path_save
+        missing = [month for month in months if month not in self.months()]
+        if missing:
+            raise ValueError("Months not analyzed yet: " + ' '.join(missing))
+        print("Merging months", ' '.join(months), "into", path_save)
+
+        buckets = set([''])
+        for month in months:
+            if os.path.exists(os.path.join(self.month_path(month), 'Buckets')):
+                buckets.update(os.listdir(os.path.join(self.month_path(month), 'Buckets')))
+        # Buckets from the last window shouldn't get merged into queries.
+        if os.path.exists(os.path.join(path_save, 'Buckets')):
+            shutil.rmtree(os.path.join(path_save, 'Buckets'))
+
+        merged_all = False
+        for bucket in sorted(buckets):
+            for name in ['white', 'black']:
+                file_name = 'wins_per_opening_' + name + '_all.bin'
+                month_stores = [os.path.join(self.bucket_path(self.month_path(month), bucket), file_name)
+                                for month in months]
+                month_stores = [path for path in month_stores if os.path.exists(path)]
+                if not month_stores:
+                    continue
+                os.makedirs(self.bucket_path(path_save, bucket), exist_ok=True)
+                # Buckets aren't pruned, like with save_all_stores.
+                merge_runs(month_stores, os.path.join(self.bucket_path(path_save, bucket), file_name),
+                           min_games=self.min_games if bucket == '' else 1)
+                merged_all = merged_all or bucket == ''
+
+        if merged_all:
+            AnalyzePGNs(path_save, checkpoint_every=None).save_from_binary()
+
+        write_json_atomic(os.path.join(path_save, 'window.json'),
+                          {'months': months, 'merged': datetime.datetime.now().isoformat()})
+
+    def refresh(self, month, window=6, pgn_path=None, num_workers=1, drop_old=False, **options):
+        # The monthly update: analyze the month that just ended and merge the last window months.
+        # With drop_old, the months that fell out of the window get deleted.
+        self.analyze_month(month, pgn_path, num_workers, **options)
+        months = self.months()
+        self.merge_window(months[-window:])
+        if drop_old:
+            for old_month in months[:-window]:
+                print("Dropping month", old_month)
+                shutil.rmtree(self.month_path(old_month))
+
+
+class EngineEvaluator(object):
+    # engine_cmd is anything popen_uci takes, e.g. 'stockfish' or [sys.executable, 'engine.py'].
+    # Each engine only gets max_time seconds per position, so a query never waits much longer.
+    def __init__(self, engine_cmd, path_cache, depth=16, num_engines=2, max_time=0.5):
+        self.engine_cmd = engine_cmd
+        self.depth = depth
+        self.max_time = max_time
+
+        # One engine per thread. They get passed around instead of opening one per position.
+        self.engines = queue.Queue()
+        for _ in range(num_engines):
+            self.engines.put(chess.engine.SimpleEngine.popen_uci(engine_cmd))
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=num_engines)
+
+        # epd -> {depth: centipawns for white}. One json line per evaluation, appended as they come in.
+        self.path_cache = path_cache
+        self.cache = {}
+        self.cache_lock = Lock()
+        # (epd, depth) -> future, so a position that's still being analyzed isn't sent twice.
+        self.pending = {}
+        if os.path.exists(path_cache):
+            with open(path_cache, 'r') as f:
+                for line in f:
+                    if line.strip():
+                        entry = json.loads(line)
+                        self.cache.setdefault(entry['fen'], {})[entry['depth']] = entry['cp']
+        self.cache_file = open(path_cache, 'a')
+
+    def cached(self, epd, depth, time_limit=False):
+        # Anything at least as deep is just as good. With a time limit, the engine usually stops
+        # short of depth anyway, so the deepest one there is gets used instead of running it again.
+        depths = self.cache.get(epd, {})
+        deeper = [d for d in depths if d >= depth or time_limit]
+        if deeper:
+            return depths[max(deeper)]
+        return None
+
+    def evaluate(self, boards, depth=None, time_limit=True):
+        # Centipawns for white for each board (mate is +-100000). None if the engine ran out of time.
+        if depth is None:
+            depth = self.depth
+        max_time = self.max_time if time_limit else None
+
+        scores = [self.cached(board.epd(), depth, time_limit) for board in boards]
+        futures = {}
+        for i, board in enumerate(boards):
+            if scores[i] is None:
+                futures[self.submit(board, depth, max_time)] = i
+        if not futures:
+            return scores
+
+        # Late ones still end up in the cache, they just don't hold up this query.
+        timeout = None if max_time is None else max_time * 2 + 1
+        done, _ = concurrent.futures.wait(futures, timeout=timeout)
+        for future in done:
+            scores[futures[future]] = future.result()
+        return scores
+
+    def submit(self, board, depth, max_time):
+        key = (board.epd(), depth)
+        with self.cache_lock:
+            if key not in self.pending:
+                self.pending[key] = self.executor.submit(self.analyse, board, depth, max_time)
+                self.pending[key].add_done_callback(lambda future: self.pending.pop(key, None))
+            return self.pending[key]
+
+    def analyse(self, board, depth, max_time):
+        engine = self.engines.get()
+        try:
+            info = engine.analyse(board, chess.engine.Limit(depth=depth, time=max_time))
+        except chess.engine.EngineError:
+            print("Engine error on", board.fen())
+            return None
+        except chess.engine.EngineTerminatedError:  # Crashed, so start a new one.
+            print("Engine died on", board.fen())
+            engine = chess.engine.SimpleEngine.popen_uci(self.engine_cmd)
+            return None
+        finally:
+            self.engines.put(engine)
 
-        with open(os.path.join(self.path_save, "wins_per_opening_black_all.json"), "w") as f:
-            json.dump(self.fen_store_b, f,
-                      indent=4, default=str)
+        if 'score' not in info:
+            return None
+        score = info['score'].white().score(mate_score=100000)
+        # Stopped by max_time means it didn't get as deep as it was asked to.
+        reached = min(info.get('depth', depth), depth)
+
+        with self.cache_lock:
+            depths = self.cache.setdefault(board.epd(), {})
+            if any(d >= reached for d in depths):  # Another thread got there first.
+                return score
+            depths[reached] = score
+            self.cache_file.write(json.dumps({'fen': board.epd(), 'depth': reached, 'cp': score}) + '\n')
+            self.cache_file.flush()
+        return score
+
+    def precompute(self, search, batch_size=256):
+        # Goes through every edge of a SearchOpenings tree without a time limit, so later
+        # queries all come from the cache.
+        if search.edges is None:
+            search.open_tree()
+        turn = 'w' if search.color == 'w' else 'b'
+        boards = []
+        for parent, children in search.edges.items():
+            for san, fen, games, wins in children:
+                board = chess.Board(parent + ' ' + turn + ' KQkq - 0 1')
+                try:
+                    board.push_san(san)
+                except ValueError:  # Castling that the guessed castling rights allowed.
+                    continue
+                boards.append(board)
+
+        print(len(boards), "positions to evaluate.")
+        for start in range(0, len(boards), batch_size):
+            self.evaluate(boards[start:start + batch_size], time_limit=False)
+            print(datetime.datetime.now(), min(start + batch_size, len(boards)), "evaluated.")
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+        while not self.engines.empty():
+            self.engines.get().quit()
+        self.cache_file.close()
+
+
+class PlyEdges(object):
+    # The edge index split into Plies/<edges_name>_NN.json by AnalyzePGNs.save_ply_shards. A shard
+    # loads the first time a position that deep is looked up, and the one after it loads in the
+    # background meanwhile, so memory only goes as deep as the sessions do.
+    def __init__(self, path_plies, edges_name):
+        self.path_plies = path_plies
+        self.edges_name = edges_name
+        self.shards = {}  # ply -> {parent: ranked children}
+        self.lock = Lock()
+        self.rest = self.load('rest')  # Small, and could be needed at any ply.
+        # A fen from outside can say it's any move number, so deeper plies look in the last shard.
+        self.max_ply = max(self.all_plies() + [1])
+        self.shard(0)
+        self.shard(1)
+
+    def load(self, shard_name):
+        try:
+            with open(os.path.join(self.path_plies, self.edges_name + '_' + shard_name + '.json'), 'r') as f:
+                return json.load(f)
+        except FileNotFoundError:  # Deeper than the index goes, or the other colour's plies.
+            return {}
+
+    def shard(self, ply):
+        shard = self.shards.get(ply)
+        if shard is None:
+            with self.lock:  # Two threads wanting the same shard only load it once.
+                shard = self.shards.get(ply)
+                if shard is None:
+                    shard = self.load(str(ply).zfill(2))
+                    self.shards[ply] = shard
+        return shard
+
+    def prefetch(self, ply):
+        if ply not in self.shards:
+            Thread(target=self.shard, args=(ply,), daemon=True).start()
+
+    def find(self, board_fen, ply):
+        # None if it's not in the index. A transposition can be in an earlier shard than its ply.
+        ply = min(ply, self.max_ply)
+        ranked = self.shard(ply).get(board_fen)
+        if ply + 2 <= self.max_ply:
+            self.prefetch(ply + 2)  # Next time it's the same side's turn.
+        if ranked is not None:
+            return ranked
+        for shard_ply in range(ply - 2, -1, -2):
+            if shard_ply in self.shards and board_fen in self.shards[shard_ply]:
+                return self.shards[shard_ply][board_fen]
+        return self.rest.get(board_fen)
+
+    def all_plies(self):
+        prefix = self.edges_name + '_'
+        return sorted(int(name[len(prefix):-5]) for name in os.listdir(self.path_plies)
+                      if name.startswith(prefix) and name[len(prefix):-5].isdigit())
+
+    def items(self):
+        # Everything, for batch jobs like EngineEvaluator.precompute.
+        for ply in self.all_plies():
+            for item in self.shard(ply).items():
+                yield item
+        for item in self.rest.items():
+            yield item
 
 
 class SearchOpenings(object):
-    def __init__(self, color, path_save):
+    # elo_range (e.g. (1000, 1200), top excluded) and game_types pick which buckets to merge.
+    # Without them, the normal store is used.
+    # engine is an optional EngineEvaluator to flag moves that only work if the opponent falls for them.
+    def __init__(self, color, path_save, elo_range=None, game_types=None, engine=None):
         self.current_pgn = ""
         self.suggestion = None
+        self.suggestion_san = None
+        # Live position of the session. key_stack has the board_fen after every move.
+        self.board = chess.Board()
+        self.san_stack = []
+        self.key_stack = []
         self.path_save = path_save
         self.color = color
+        self.elo_range = elo_range
+        self.game_types = game_types
         self.root = None
+        self.edges = None
+        self.engine = engine
+        self.trap_cp = 150  # Flagged if the engine has it worse than this for whoever plays it.
+        # Replace with Metrics(path, 'query') to have them written out.
+        self.metrics = Metrics()
 
     def new_game(self):
-        self.current_pgn = ""
+        self.reset_board()
 
         if self.root == None:  # Shouldn't happen if you're loading them at the beginning.
             self.open_tree()
 
         while True:
             if self.input_pgn() == 0:  # Not found.
-                self.current_pgn = ""
+                self.reset_board()
                 break
 
+    def reset_board(self):
+        self.board = chess.Board()
+        self.san_stack = []
+        self.key_stack = []
+        self.current_pgn = ""
+        self.suggestion = None
+        self.suggestion_san = None
+
+    def push_move(self, san):
+        move = self.board.parse_san(san)
+        self.san_stack.append(self.board.san(move))
+        self.board.push(move)
+        self.key_stack.append(self.board.board_fen())
+        self.update_current_pgn()
+
+    def pop_move(self):
+        if len(self.san_stack) == 0:
+            return
+        self.board.pop()
+        self.san_stack.pop()
+        self.key_stack.pop()
+        self.update_current_pgn()
+
+    def push_pgn(self, add_to_pgn):
+        # Several moves can be typed at once. Either all of them go on the board or none.
+        pushed = 0
+        try:
+            for move in add_to_pgn.split(' '):
+                if move == '' or move.endswith('.'):  # Move numbers (e.g. '1.') are fine.
+                    continue
+                self.push_move(move)
+                pushed += 1
+        except ValueError:
+            for _ in range(pushed):
+                self.pop_move()
+            return False
+
+        return pushed > 0
+
+    def update_current_pgn(self):
+        self.suggestion = None
+        self.suggestion_san = None
+        # Always ends with a space once there's a move, like when the moves were typed in.
+        if len(self.san_stack) == 0:
+            self.current_pgn = ""
+        else:
+            self.current_pgn = ' '.join(self.san_stack) + " "
+
+    def current_key(self):
+        if len(self.key_stack) == 0:
+            return chess.STARTING_BOARD_FEN
+        return self.key_stack[-1]
+
     def open_tree(self):
         if self.color == 'w':
-            with open(self.path_save + '\\wins_per_opening_white_all.json', 'r') as f:
-                self.root = json.load(f)
+            file_name = 'wins_per_opening_white_all'
         else:
-            with open(self.path_save + '\\wins_per_opening_black_all.json', 'r') as f:
-                self.root = json.load(f)
+            file_name = 'wins_per_opening_black_all'
+
+        if self.elo_range is not None or self.game_types is not None:
+            # The edge index is per store, so merged buckets go through the legal moves instead.
+            buckets = self.find_buckets()
+            print("Merging", len(buckets), "buckets:", ' '.join(buckets))
+            self.root = MergedStore([self.open_store(os.path.join(self.path_save, 'Buckets', bucket), file_name)
+                                     for bucket in buckets])
+            return
+
+        self.root = self.open_store(self.path_save, file_name)
+
+        # With the edge index, suggestions don't need to go through every legal move. Split by ply,
+        # only the first plies are loaded now and the rest once a session gets there.
+        edges_name = 'edges_' + ('white' if self.color == 'w' else 'black')
+        edges_path = os.path.join(self.path_save, file_name.replace('wins', 'edges') + '.json')
+        if os.path.exists(os.path.join(self.path_save, 'Plies', edges_name + '_rest.json')):
+            self.edges = PlyEdges(os.path.join(self.path_save, 'Plies'), edges_name)
+        elif os.path.exists(edges_path):  # Stores from before the shards.
+            with open(edges_path, 'r') as f:
+                self.edges = json.load(f)
+
+    def open_store(self, path_store, file_name):
+        # The binary store opens instantly, so use it whenever it's there.
+        if os.path.exists(os.path.join(path_store, file_name + '.bin')):
+            return PositionStore(os.path.join(path_store, file_name + '.bin'))
+        with open(os.path.join(path_store, file_name + '.json'), 'r') as f:
+            return json.load(f)
+
+    def find_buckets(self):
+        # Bucket names look like 'blitz_1500', for 1500 up to the next band.
+        buckets = []
+        for bucket in sorted(os.listdir(os.path.join(self.path_save, 'Buckets'))):
+            game_type, _, band = bucket.rpartition('_')
+            if self.game_types is not None and game_type not in self.game_types:
+                continue
+            if self.elo_range is not None and not self.elo_range[0] <= int(band) < self.elo_range[1]:
+                continue
+            buckets.append(bucket)
+
+        return buckets
 
     def input_pgn(self):
         add_to_pgn = input("Current PGN: " + self.current_pgn)
         add_to_pgn = self.clean_add_to_pgn(add_to_pgn)
 
         if add_to_pgn == 'n':  # New game.
-            self.current_pgn = ""
+            self.reset_board()
             print("\n\n")
             return 0
-        # Undo last move. It deletes the last space and the last move.
+        # Undo last move.
         elif add_to_pgn == 'u':
-            self.current_pgn = ' '.join(self.current_pgn.split(' ')[:-2])
+            self.pop_move()
         elif add_to_pgn == 'a':  # Accept suggestion.
-            if self.suggestion is None:
+            if self.suggestion_san is None:
                 print("No suggestion.")
                 return
-            self.current_pgn = self.suggestion
+            self.push_move(self.suggestion_san)
         elif add_to_pgn == 'r':  # Want more than one rank.
             rank = input("Rank: ")
             try:
@@ -450,32 +2913,28 @@ class SearchOpenings(object):
             if self.find_operation(rank=rank) == 0:  # Not found.
                 return 0
         else:
-            if not self.validate_pgn(add_to_pgn):
+            if not self.push_pgn(add_to_pgn):
                 print("Invalid move.")
                 return
 
-            self.current_pgn += add_to_pgn
             if self.find_operation() == 0:  # Not found.
                 return 0
 
-        # If it's length 0, we don't want a space.
-        if self.current_pgn != '' and add_to_pgn != 'r':
-            self.current_pgn += " "
-
     def find_operation(self, rank=5):
-        if not self.last_move_color(self.current_pgn):
-            recorded_moves, board = self.next_fen_finder()
+        if not self.last_move_color():
+            with self.metrics.timer('query_seconds'), self.metrics.profiled('next_fen_finder'):
+                recorded_moves, board = self.next_fen_finder()
+            self.metrics.inc('queries')
+            self.metrics.tick()
             if len(recorded_moves) == 0:  # Nothing found in database.
                 print("Not found in database.\n\n")
                 return 0
             # Use this unless user comments it out because this is the whole purpose of the program.
             sorted_moves = self.basic_sort_moves(recorded_moves)
-            self.print_all_sugg(sorted_moves, board, rank)
+            self.print_all_sugg(sorted_moves, board, rank, self.engine_check(sorted_moves, board, rank))
         else:
             try:
-                current_fen = self.pgn_to_fen().fen()
-                current_fen = self.remove_trivial_parts_fen(current_fen)
-                fen_stats = self.root[current_fen]
+                fen_stats = self.root[self.current_key()]
                 self.print_sugg(self.current_pgn, fen_stats[0], fen_stats[1])
             except KeyError:
                 print("Not found in database.")
@@ -483,59 +2942,97 @@ class SearchOpenings(object):
 
     def clean_add_to_pgn(self, string):
         while string.count('  ') > 0:
-            string.replace("  ", ' ')
+            string = string.replace("  ", ' ')
         if len(string) > 0 and string[-1] == ' ':
             string = string[:-1]
 
         return string
 
-    def validate_pgn(self, add_to_pgn):
-        if len(self.current_pgn) == 0:
-            validation_board = chess.Board()
-        else:
-            validation_board = chess.Board()
-            # We don't want the last space.
-            for move in self.current_pgn.split(' ')[:-1]:
-                validation_board.push_san(move)
-
-        try:
-            if len(add_to_pgn) > 0:
-                for move in add_to_pgn.split(' '):
-                    validation_board.push_san(move)
-        except ValueError:
-            return False
-
-        return True
-
     def next_fen_finder(self):
         board = self.pgn_to_fen()
+        return self.position_moves(board, self.current_key()), board
+
+    def position_moves(self, board, board_fen=None):
+        # Doesn't touch the session, so the server can call it for any board.
+        if board_fen is None:
+            board_fen = board.board_fen()
+
+        # The index has no en passant captures, so those positions still go the long way.
+        ranked = None
+        if self.edges is not None and not board.has_legal_en_passant():
+            if isinstance(self.edges, PlyEdges):
+                ranked = self.edges.find(board_fen, board.ply())
+            else:
+                ranked = self.edges.get(board_fen)
+        if ranked is not None:
+            # Already ranked by the analyzer. The san goes at the end so it doesn't need fen_to_pgn.
+            recorded_moves = []
+            for san, fen, games, wins in ranked:
+                if self.is_legal_edge(board, san):
+                    recorded_moves.append([fen, games, wins, san])
+            return recorded_moves
 
-        possible_moves_fen = []
+        recorded_moves = []
+        new_board = board.copy(stack=False)
         for move in list(board.legal_moves):
-            new_board = board.copy()
             new_board.push(move)
-
-            possible_moves_fen.append(new_board.fen())
-
-        recorded_moves = []
-        for fen in possible_moves_fen:
-            fen = self.remove_trivial_parts_fen(fen)
             try:
-                fen_stats = self.root[fen]
-                recorded_moves.append([fen, fen_stats[0], fen_stats[1]])
-            except:
+                fen_stats = self.board_stats(new_board)
+                recorded_moves.append([new_board.board_fen(), fen_stats[0], fen_stats[1], board.san(move)])
+            except KeyError:
                 pass
+            new_board.pop()
+
+        return recorded_moves
+
+    def board_stats(self, board):
+        # Hashes the board itself, since going through its fen was most of the lookup.
+        if isinstance(self.root, PositionStore):
+            return self.root.get_by_hash(zobrist_hasher.hash_board(board))
+        if isinstance(self.root, MergedStore):
+            return self.root.get_by_hash(zobrist_hasher.hash_board(board), board.board_fen())
+        return self.root[board.board_fen()]
+
+    def ranked_moves(self, board, rank=5):
+        # Same ranking as the interactive suggestions, but returned instead of printed.
+        ranked = []
+        with self.metrics.timer('query_seconds'), self.metrics.profiled('position_moves'):
+            recorded_moves = self.position_moves(board)
+        self.metrics.inc('queries')
+        self.metrics.tick()
+        sorted_moves = self.basic_sort_moves(recorded_moves)[:rank]
+        engine_scores = self.engine_check(sorted_moves, board, rank)
+        for fen in sorted_moves:
+            if len(fen) > 3:
+                san = fen[3]
+            else:
+                san = self.fen_to_san(board, fen[0])
+            ranked.append({'san': san, 'games': fen[1], 'score': fen[2] / fen[1]})
+            if engine_scores:
+                ranked[-1]['engine_cp'] = engine_scores[fen[0]]
+                ranked[-1]['trap'] = engine_scores[fen[0]] is not None and engine_scores[fen[0]] < -self.trap_cp
+
+        return ranked
+
+    def position_stats(self, board):
+        try:
+            fen_stats = self.root[board.board_fen()]
+        except KeyError:
+            return None
+        return {'games': fen_stats[0], 'score': fen_stats[1] / fen_stats[0]}
 
-        return recorded_moves, board
-
-    def last_move_color(self, string):
-        if string == '':  # No moves yet.
-            return (self.color == 'b')
+    def is_legal_edge(self, board, san):
+        # The index guessed the castling rights, so check castling against the real board.
+        if san.startswith('O-O'):
+            try:
+                board.parse_san(san)
+            except ValueError:
+                return False
+        return True
 
-        if string[-1] == ' ':
-            string = string[:-1]
-        num_moves = len(string.split(" "))
-        if num_moves % 2 == 1:
+    def last_move_color(self):
+        # No moves yet counts as black having moved last.
+        if len(self.board.move_stack) % 2 == 1:
             return (self.color == 'w')
         else:
             return (self.color == 'b')
@@ -553,31 +3050,29 @@ class SearchOpenings(object):
         return fen
 
     def pgn_to_fen(self):
-        if self.current_pgn == "":  # First move for white.
-            return chess.Board()
-        game = chess.pgn.read_game(io.StringIO(self.current_pgn))
-        board = game.board()
-        for move in game.mainline_moves():
-            board.push(move)
-
-        return board
+        # Kept up to date move by move, so nothing to parse. Don't push on it.
+        return self.board
 
     # Note that this doesn't add numbering to the moves.
     def fen_to_pgn(self, board, target_fen):
+        return self.add_move_to_pgn(self.fen_to_san(board, target_fen))
+
+    def fen_to_san(self, board, target_fen):
         for move in list(board.legal_moves):
             new_board = board.copy()
             new_board.push(move)
             if self.remove_trivial_parts_fen(new_board.fen()) == target_fen:
-                # Delete that first space if self.current_pgn is nothing.
-                if self.current_pgn == '':
-                    new_pgn = board.san(move)
-                # This is when you're asking for rank (not first time).
-                elif self.current_pgn[-1] == ' ':
-                    new_pgn = self.current_pgn + board.san(move)
-                else:  # Normal case.
-                    new_pgn = self.current_pgn + " " + board.san(move)
-
-        return new_pgn
+                return board.san(move)
+
+    def add_move_to_pgn(self, san):
+        # Delete that first space if self.current_pgn is nothing.
+        if self.current_pgn == '':
+            return san
+        # This is when you're asking for rank (not first time).
+        elif self.current_pgn[-1] == ' ':
+            return self.current_pgn + san
+        else:  # Normal case.
+            return self.current_pgn + " " + san
 
     def basic_sort_moves(self, recorded_moves):
         sum_moves = 0  # Delete this par.
@@ -595,23 +3090,331 @@ class SearchOpenings(object):
         good_moves.sort(key=lambda item: item[2]/item[1], reverse=True)
         return good_moves
 
-    def print_all_sugg(self, recorded_moves, board, rank=5):
+    def engine_check(self, sorted_moves, board, rank=5):
+        # Only the moves that get shown are checked, all at once. fen -> centipawns for the mover.
+        if self.engine is None:
+            return {}
+        children = []
+        for fen in sorted_moves[:rank]:
+            child = board.copy(stack=False)
+            child.push_san(fen[3] if len(fen) > 3 else self.fen_to_san(board, fen[0]))
+            children.append(child)
+
+        sign = 1 if board.turn == chess.WHITE else -1
+        scores = self.engine.evaluate(children)
+        return {fen[0]: None if score is None else score * sign
+                for fen, score in zip(sorted_moves, scores)}
+
+    def engine_note(self, score):
+        if score is None:
+            return "engine: ?"
+        note = "engine: " + str(round(score / 100, 2))
+        if score < -self.trap_cp:
+            note += "  TRAP? Loses against the right reply."
+        return note
+
+    def print_all_sugg(self, recorded_moves, board, rank=5, engine_scores=None):
         rank_num = 1
         for fen in recorded_moves:
             # new_sugg = fen[0] + "   " + str(fen[1]) + "   " + str(fen[2])
-            new_sugg = self.fen_to_pgn(board, fen[0])
-            self.print_sugg(new_sugg, fen[1], fen[2])
+            if len(fen) > 3:  # The san is already there.
+                new_sugg = self.add_move_to_pgn(fen[3])
+            else:
+                new_sugg = self.fen_to_pgn(board, fen[0])
+            if engine_scores:
+                self.print_sugg(new_sugg, fen[1], fen[2], self.engine_note(engine_scores.get(fen[0])))
+            else:
+                self.print_sugg(new_sugg, fen[1], fen[2])
 
             if rank_num == 1:  # If only one rank is needed, use that suggestion.
                 self.suggestion = new_sugg
+                self.suggestion_san = new_sugg.split(' ')[-1]
 
             if rank_num == rank:
                 break
             rank_num += 1
 
-    def print_sugg(self, pgn, games_played, wins):
-        print(pgn, '   ', games_played, '   ', str(
-            round(Decimal(wins)/Decimal(games_played)*100, 3)) + "%")
+    def print_sugg(self, pgn, games_played, wins, note=None):
+        if note is None:
+            print(pgn, '   ', games_played, '   ', str(
+                round(Decimal(wins)/Decimal(games_played)*100, 3)) + "%")
+        else:
+            print(pgn, '   ', games_played, '   ', str(
+                round(Decimal(wins)/Decimal(games_played)*100, 3)) + "%", '   ', note)
+
+
+class RepertoireBuilder(object):
+    # A whole repertoire in one go instead of move by move: our best move (the first suggestion)
+    # when it's our turn and the opponent's common replies when it's theirs, for depth plies. A
+    # position reached by a transposition is only looked at once. A reply needs reply_share of the
+    # games there, and every move needs min_games.
+    def __init__(self, color, path_save, depth=12, reply_share=0.1, max_replies=3, min_games=10,
+                 elo_range=None, game_types=None):
+        self.color = color
+        self.depth = depth
+        self.reply_share = reply_share
+        self.max_replies = max_replies
+        self.min_games = min_games
+        # Everything a worker process needs to make the same builder.
+        self.options = {'color': color, 'path_save': path_save, 'depth': depth, 'reply_share': reply_share,
+                        'max_replies': max_replies, 'min_games': min_games, 'elo_range': elo_range,
+                        'game_types': game_types}
+
+        # Our moves are in our store and the replies in the other one.
+        self.ours = SearchOpenings(color, path_save, elo_range, game_types)
+        self.theirs = SearchOpenings('b' if color == 'w' else 'w', path_save, elo_range, game_types)
+        self.ours.open_tree()
+        self.theirs.open_tree()
+
+        # epd -> {'plies_left': ..., 'moves': [{'san', 'games', 'score', 'next': epd}, ...]}
+        self.positions = {}
+        self.root = chess.Board().epd()
+
+    def build_all(self, num_workers=1, split_plies=4):
+        if num_workers <= 1:
+            self.build(chess.Board(), self.depth)
+            return
+
+        # The first split_plies get built here. Every position after that is a subtree for a worker.
+        frontier = {}
+        self.build(chess.Board(), self.depth, frontier, self.depth - split_plies)
+        print("Building", len(frontier), "subtrees with", num_workers, "workers.")
+
+        subtrees = list(frontier.values())
+        chunks = [subtrees[i::num_workers * 4] for i in range(num_workers * 4)]
+        executor = concurrent.futures.ProcessPoolExecutor(max_workers=num_workers)
+        futures = [executor.submit(build_subtrees, self.options, chunk) for chunk in chunks if chunk]
+        for future in futures:
+            for key, node in future.result().items():
+                # Workers don't share what they've seen, so keep the one that goes deepest.
+                if key not in self.positions or self.positions[key]['plies_left'] < node['plies_left']:
+                    self.positions[key] = node
+        executor.shutdown(wait=True)
+
+    def build(self, board, plies_left, frontier=None, split_at=None):
+        # Returns the position's key. With a frontier, positions at split_at plies left go in it instead.
+        key = board.epd()
+        node = self.positions.get(key)
+        if node is not None and node['plies_left'] >= plies_left:  # Transposition or repetition.
+            return key
+        if frontier is not None and plies_left == split_at:
+            frontier[key] = (board.fen(), plies_left)
+            return key
+
+        node = {'plies_left': plies_left, 'moves': []}
+        self.positions[key] = node
+        if plies_left > 0:
+            for san, games, score in self.candidates(board):
+                child = board.copy(stack=False)
+                child.push_san(san)
+                node['moves'].append({'san': san, 'games': games, 'score': score,
+                                      'next': self.build(child, plies_left - 1, frontier, split_at)})
+        return key
+
+    def candidates(self, board):
+        # (san, games, score for whoever moves) of every move from here that's in the repertoire.
+        if (board.turn == chess.WHITE) == (self.color == 'w'):
+            recorded_moves = self.ours.basic_sort_moves(self.ours.position_moves(board))[:1]
+        else:
+            recorded_moves = self.theirs.position_moves(board)
+            total = sum(fen[1] for fen in recorded_moves)
+            recorded_moves = sorted(recorded_moves, key=lambda fen: fen[1], reverse=True)[:self.max_replies]
+            recorded_moves = [fen for fen in recorded_moves if fen[1] >= self.reply_share * total]
+
+        moves = []
+        for fen in recorded_moves:
+            if fen[1] < self.min_games:
+                continue
+            san = fen[3] if len(fen) > 3 else self.ours.fen_to_san(board, fen[0])
+            moves.append((san, fen[1], fen[2] / fen[1]))
+        return moves
+
+    def to_json(self):
+        return {'color': self.color, 'depth': self.depth, 'root': self.root, 'positions': self.positions}
+
+    def to_pgn(self):
+        # Our moves are the main line. The most common reply comes first and the others are variations.
+        game = chess.pgn.Game()
+        game.headers['Event'] = 'Opening Oracle repertoire'
+        game.headers['White' if self.color == 'w' else 'Black'] = 'Repertoire'
+        self.add_variations(game, chess.Board(), self.root, self.depth)
+        return str(game)
+
+    def add_variations(self, pgn_node, board, key, plies_left):
+        # plies_left stops it at a repetition, where a position's moves lead back to itself.
+        if plies_left == 0 or key not in self.positions:
+            return
+        for move_info in self.positions[key]['moves']:
+            move = board.parse_san(move_info['san'])
+            child = pgn_node.add_variation(move, comment=str(move_info['games']) + ' games, ' +
+                                           str(round(move_info['score'] * 100, 1)) + '%')
+            board.push(move)
+            self.add_variations(child, board, move_info['next'], plies_left - 1)
+            board.pop()
+
+    def save(self, file_path):
+        # file_path without the extension. Writes both the .json and the .pgn.
+        write_json_atomic(file_path + '.json', self.to_json(), indent=4)
+        with open(file_path + '.pgn.tmp', 'w') as f:
+            f.write(self.to_pgn() + '\n')
+        os.replace(file_path + '.pgn.tmp', file_path + '.pgn')
+
+
+def build_subtrees(options, subtrees):
+    # Runs in a worker process with its own builder. subtrees are (fen, plies left).
+    builder = RepertoireBuilder(**options)
+    for fen, plies_left in subtrees:
+        builder.build(chess.Board(fen), plies_left)
+    return builder.positions
+
+
+def build_repertoires(path_save, depth=12, num_workers=1, by_band=False, game_types=None, **options):
+    # Both colors into Repertoires/, for the whole store or (by_band) for every elo band in Buckets.
+    # options are the rest of RepertoireBuilder's.
+    path_repertoires = os.path.join(path_save, 'Repertoires')
+    os.makedirs(path_repertoires, exist_ok=True)
+    if by_band:
+        bands = sorted(set(int(bucket.rpartition('_')[2]) for bucket in os.listdir(os.path.join(path_save, 'Buckets'))))
+        elo_ranges = [(str(band), (band, band + 1)) for band in bands]  # Only that band's buckets.
+    else:
+        elo_ranges = [('all', None)]
+
+    for name, elo_range in elo_ranges:
+        for color, color_name in [('w', 'white'), ('b', 'black')]:
+            start = time.time()
+            builder = RepertoireBuilder(color, path_save, depth, elo_range=elo_range, game_types=game_types, **options)
+            builder.build_all(num_workers)
+            builder.save(os.path.join(path_repertoires, name + '_' + color_name))
+            print("Repertoire", name, color_name + ":", len(builder.positions), "positions in",
+                  round(time.time() - start, 1), "s")
+
+
+class OracleServer(object):
+    def __init__(self, path_save, cache_size=100000, max_rank=20):
+        # Both trees are loaded once and only read from, so every request thread shares them.
+        self.openings = {'w': SearchOpenings('w', path_save), 'b': SearchOpenings('b', path_save)}
+        for search in self.openings.values():
+            search.open_tree()
+
+        self.max_rank = max_rank
+        self.cache_size = cache_size
+        self.cache = OrderedDict()  # (kind, fen, rank) -> answer. Oldest first.
+        self.cache_lock = Lock()
+
+    def parse_board(self, query):
+        # A position is either a list of moves or a fen.
+        if not isinstance(query.get('fen', ''), str) or not isinstance(query.get('pgn', ''), str):
+            raise ValueError("fen and pgn have to be strings.")
+        if 'fen' in query:
+            return chess.Board(query['fen'])
+
+        board = chess.Board()
+        for move in query.get('pgn', '').split():
+            if not move.endswith('.'):  # Skip move numbers.
+                board.push_san(move)
+        return board
+
+    def answer(self, query):
+        if not isinstance(query, dict):
+            raise ValueError("A query has to be an object, e.g. {\"pgn\": \"e4 e5\"}.")
+        kind = query.get('type', 'suggest')
+        if kind not in ['suggest', 'stats']:
+            raise ValueError("Unknown query type: " + str(kind))
+        try:
+            rank = int(query.get('rank', 5))
+        except (TypeError, ValueError):
+            rank = None
+        if rank is None or not 1 <= rank <= self.max_rank:
+            raise ValueError("rank has to be from 1 to " + str(self.max_rank) + ".")
+        board = self.parse_board(query)
+
+        # Castling rights and en passant change the legal moves, so they're part of the key.
+        key = (kind, board.epd(), rank)
+        with self.cache_lock:
+            if key in self.cache:
+                self.cache.move_to_end(key)
+                return self.cache[key]
+
+        if kind == 'suggest':
+            # Suggestions come from the tree of whoever is to move.
+            color = 'w' if board.turn == chess.WHITE else 'b'
+            result = {'fen': board.fen(), 'moves': self.openings[color].ranked_moves(board, rank)}
+        else:
+            # The position was reached by the other side's move, so it's in their tree.
+            color = 'b' if board.turn == chess.WHITE else 'w'
+            result = {'fen': board.fen(), 'stats': self.openings[color].position_stats(board)}
+
+        with self.cache_lock:
+            self.cache[key] = result
+            if len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+
+        return result
+
+    def batch(self, queries):
+        results = []
+        for query in queries:
+            try:
+                results.append(self.answer(query))
+            except ValueError as e:  # One bad position shouldn't fail the whole batch.
+                results.append({'error': str(e)})
+        return results
+
+
+class OracleRequestHandler(BaseHTTPRequestHandler):
+    # GET /suggest?pgn=e4 e5&rank=5, GET /stats?fen=..., POST /batch with {"queries": [...]}.
+    oracle = None
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        query = dict((name, values[-1]) for name, values in parse_qs(url.query).items())
+        if url.path not in ['/suggest', '/stats']:
+            self.send_json(404, {'error': "Unknown endpoint."})
+            return
+
+        query['type'] = url.path[1:]
+        try:
+            self.send_json(200, self.oracle.answer(query))
+        except ValueError as e:
+            self.send_json(400, {'error': str(e)})
+
+    def do_POST(self):
+        if urlparse(self.path).path != '/batch':
+            self.send_json(404, {'error': "Unknown endpoint."})
+            return
+
+        try:
+            body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+            queries = body['queries']
+            if not isinstance(queries, list):
+                raise TypeError
+        except (ValueError, KeyError, TypeError):
+            self.send_json(400, {'error': "Expected {\"queries\": [...]}."})
+            return
+
+        self.send_json(200, {'results': self.oracle.batch(queries)})
+
+    def send_json(self, status, data):
+        body = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass  # One line per request is too much at this rate.
+
+
+def serve(path_save, host='127.0.0.1', port=8000, cache_size=100000):
+    OracleRequestHandler.oracle = OracleServer(path_save, cache_size)
+    server = ThreadingHTTPServer((host, port), OracleRequestHandler)
+    print("Serving on http://" + host + ":" + str(port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
 
 
 def main():
@@ -626,12 +3429,25 @@ def main():
         elo_from, elo_to, path_save, game_type = get_first_parameters()
 
         pgn_downloader = DownloadPGNs(elo_from, elo_to, path_save, game_type)
-        # pgn_downloader.load_usernames() # Only for backwards compatibility.
+        # Rates and latencies go to Metrics/, to keep an eye on a long crawl.
+        pgn_downloader.metrics = Metrics(os.path.join(path_save, 'Metrics'), 'download')
+        # pgn_downloader.load_usernames() # If they were already all downloaded.
         pgn_downloader.download_usernames()
         pgn_downloader.download_games()
-        pgn_downloader.fix_all_pgns()
 
-        AnalyzePGNs(path_save).analyzer()
+        pgn_analyzer = AnalyzePGNs(path_save)
+        pgn_analyzer.metrics = Metrics(os.path.join(path_save, 'Metrics'), 'analyze')
+        pgn_analyzer.analyzer(num_workers=os.cpu_count())
+        # build_repertoires(path_save, depth=12, num_workers=os.cpu_count())  # Repertoires/*.pgn and .json
+        # Or offline from a monthly dump, without downloading anything:
+        # ingest_dump('lichess_db_standard_rated_2022-09.pgn.zst', elo_from, elo_to, path_save, game_type,
+        #             num_workers=os.cpu_count())
+        # Or month by month, so next month only that month needs analyzing:
+        # DownloadPGNs(elo_from, elo_to, path_save, game_type, by_month=True).download_month(2022, 9)
+        # MonthlyStores(path_save).refresh('2022-09', window=6, num_workers=os.cpu_count())
+        # To re-analyze later without parsing SAN again:
+        # pgn_analyzer.encode_move_corpus(os.path.join(path_save, 'all_games.mvs'))
+        # AnalyzePGNs(path_save, os.path.join(path_save, 'all_games.mvs')).analyzer()
 
     else:
         # path_save = input("Where are the jsons saved? ")
@@ -680,3 +3496,4 @@ def run_only():
 if __name__ == "__main__":
     main()
     # run_only()
+    # serve(path_save)  # JSON API instead of the input() loop.
@@ -0,0 +1,280 @@
+import datetime
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+import chess
+
+from Opening_Oracle import AnalyzePGNs, DownloadPGNs, GameDeduplicator, PGNStripper, SearchOpenings, write_json_atomic
+
+# Base and increment for the TimeControl header, picked at random. '1/86400' is a daily game.
+GENERATED_TIME_CONTROLS = ['60', '120+1', '180', '180+2', '300', '300+5', '600', '900+10', '1800', '1/86400']
+GENERATED_RESULTS = ['1-0', '0-1', '1/2-1/2']
+
+
+def generate_dump(dump_path, num_games=10000, seed=0, opening_plies=12, opening_skew=0.6):
+    # chess.com style archive: headers, clock comments, a few variants and daily games. The same
+    # seed always gives the same file. The first opening_plies moves lean towards the first legal
+    # moves, so openings get shared like in real games. A higher opening_skew shares more of them.
+    rng = random.Random(seed)
+    with open(dump_path, 'w') as f:
+        for game_num in range(num_games):
+            board = chess.Board()
+            moves = []
+            for ply in range(rng.randint(10, 80)):
+                legal_moves = list(board.legal_moves)  # Always generated in the same order.
+                if not legal_moves:
+                    break
+                if ply < opening_plies:
+                    move = legal_moves[min(int(rng.expovariate(opening_skew)), len(legal_moves) - 1)]
+                else:
+                    move = rng.choice(legal_moves)
+                moves.append(board.san(move))
+                board.push(move)
+
+            result = rng.choice(GENERATED_RESULTS)
+            elo = rng.randint(400, 2400)
+            f.write('[Event "Live Chess"]\n[Site "Chess.com"]\n')
+            f.write('[Date "2022.' + str(rng.randint(1, 12)).zfill(2) + '.' + str(rng.randint(1, 28)).zfill(2) + '"]\n')
+            f.write('[White "user' + str(rng.randint(0, 99999)) + '"]\n')
+            f.write('[Black "user' + str(rng.randint(0, 99999)) + '"]\n')
+            f.write('[Result "' + result + '"]\n')
+            if rng.random() < 0.02:
+                f.write('[Variant "Chess960"]\n')
+            f.write('[WhiteElo "' + str(elo + rng.randint(-100, 100)) + '"]\n')
+            f.write('[BlackElo "' + str(elo + rng.randint(-100, 100)) + '"]\n')
+            f.write('[TimeControl "' + rng.choice(GENERATED_TIME_CONTROLS) + '"]\n')
+            f.write('[Termination "user won by resignation"]\n\n')
+
+            pgn = []
+            for ply, san in enumerate(moves):
+                clock = '{[%clk 0:0' + str(rng.randint(0, 9)) + ':' + str(rng.randint(0, 59)).zfill(2) + '.' + str(rng.randint(0, 9)) + ']}'
+                if ply % 2 == 0:
+                    pgn.append(str(ply // 2 + 1) + '. ' + san + ' ' + clock)
+                else:
+                    pgn.append(str(ply // 2 + 1) + '... ' + san + ' ' + clock)
+            f.write(' '.join(pgn) + ' ' + result + '\n\n')
+
+
+def timed(function, *args):
+    start = time.perf_counter()
+    result = function(*args)
+    return time.perf_counter() - start, result
+
+
+def bench_read_pgn(pgn_path, num_games=100000):
+    # Counts the same games with read_pgn and read_pgn_fast and compares positions/sec.
+    results = {}
+    for name, san_cache_size in [('read_pgn', 0), ('read_pgn_fast', 200000)]:
+        analyzer = AnalyzePGNs(os.path.dirname(pgn_path), pgn_path, san_cache_size=san_cache_size)
+
+        start = time.perf_counter()
+        for i, (offset, pgn) in enumerate(analyzer.iter_pgn_lines()):
+            if i == num_games:
+                break
+            analyzer.read_line(i, pgn)
+        seconds = time.perf_counter() - start
+
+        positions = sum(stats[0] for stats in analyzer.fen_store_w.values()) + \
+            sum(stats[0] for stats in analyzer.fen_store_b.values())
+        results[name] = positions / seconds
+        print(name, '   ', round(seconds, 3), 's   ', round(positions / seconds), 'positions/sec')
+
+    # Every miss adds a node, so this is the share of moves that didn't need python-chess. The
+    # speedup can't be much more than 1 / (1 - hit rate), so it depends on how much openings overlap.
+    results['san_cache_hit_rate'] = 1 - analyzer.san_cache_used / max(positions, 1)
+    print("Speedup:", round(results['read_pgn_fast'] / results['read_pgn'], 2), "x   ",
+          "san cache hit rate:", round(results['san_cache_hit_rate'], 3))
+    return results
+
+
+def bench_move_corpus(pgn_path, repeat=3):
+    # Encodes the text corpus once, then analyzes both and compares size and positions/sec. Both
+    # only need python-chess on san cache misses, and pushing the move and getting the fen there costs
+    # the same, so the gap is small. The best of repeat runs each keeps the noise out of it.
+    path_bench = os.path.dirname(pgn_path)
+    corpus_path = os.path.join(path_bench, 'all_games.mvs')
+    encode_seconds, num_games = timed(AnalyzePGNs(path_bench, pgn_path).encode_move_corpus, corpus_path)
+
+    result = {'encode_seconds': encode_seconds, 'text_bytes': os.path.getsize(pgn_path),
+              'corpus_bytes': os.path.getsize(corpus_path)}
+    for run in range(repeat):
+        for name, path in [('text', pgn_path), ('move_corpus', corpus_path)]:
+            analyzer = AnalyzePGNs(path_bench, path)
+            start = time.perf_counter()
+            positions = sum(analyzer.read_line(i, game) or 0 for i, (offset, game) in enumerate(analyzer.iter_games()))
+            result[name + '_positions_per_sec'] = max(result.get(name + '_positions_per_sec', 0),
+                                                      positions / (time.perf_counter() - start))
+
+    print('move corpus   ', num_games, 'games   ', round(result['text_bytes'] / result['corpus_bytes'], 2),
+          'x smaller   ', round(result['text_positions_per_sec']), 'text positions/sec   ',
+          round(result['move_corpus_positions_per_sec']), 'corpus positions/sec')
+    return result
+
+
+def bench_strip(dump_path, game_type='blitz'):
+    # Runs a raw chess.com style dump (headers, clocks and all) through PGNStripper, with dedup
+    # like a real download.
+    downloader = DownloadPGNs(0, 4000, os.path.dirname(dump_path), game_type)
+    downloader.dedup = GameDeduplicator(None)
+    stripper = PGNStripper(downloader)
+
+    start = time.perf_counter()
+    num_bytes = 0
+    with open(dump_path, 'r') as f:
+        for line in f:
+            num_bytes += len(line)
+            stripper.feed(line.rstrip('\n'))
+    seconds = time.perf_counter() - start
+
+    result = {'seconds': seconds, 'mb_per_sec': num_bytes / seconds / 1e6,
+              'games_kept': len(stripper.new_pgn), 'duplicates': downloader.dedup.duplicates}
+    print('strip   ', round(seconds, 3), 's   ', round(result['mb_per_sec'], 2), 'MB/sec   ',
+          result['games_kept'], 'games kept')
+    return result
+
+
+def bench_strip_user_pgn(dump_path, game_type='blitz'):
+    # The whole dump as if it was one user's monthly archive.
+    downloader = DownloadPGNs(0, 4000, os.path.dirname(dump_path), game_type)
+    with open(dump_path, 'r') as f:
+        user_pgn = f.read()
+
+    seconds, stripped = timed(downloader.strip_user_pgn, user_pgn)
+    result = {'seconds': seconds, 'mb_per_sec': len(user_pgn) / seconds / 1e6,
+              'games_kept': len(stripped.splitlines())}
+    print('strip_user_pgn   ', round(seconds, 3), 's   ', round(result['mb_per_sec'], 2), 'MB/sec')
+    return result
+
+
+def bench_keep_only_opening(dump_path):
+    downloader = DownloadPGNs(0, 4000, os.path.dirname(dump_path))
+    with open(dump_path, 'r') as f:
+        lines = [downloader.delete_extra_parts_pgn(line.rstrip('\n')) for line in f if line.startswith('1.')]
+
+    start = time.perf_counter()
+    for line in lines:
+        downloader.keep_only_opening(line)
+    seconds = time.perf_counter() - start
+
+    result = {'seconds': seconds, 'games_per_sec': len(lines) / seconds}
+    print('keep_only_opening   ', round(seconds, 3), 's   ', round(result['games_per_sec']), 'games/sec')
+    return result
+
+
+def bench_store_io(path_save):
+    # Saving and loading the json store, and writing and opening the binary one.
+    analyzer = AnalyzePGNs(path_save, checkpoint_every=None)
+    analyzer.load_fen_store()
+    positions = len(analyzer.fen_store_w) + len(analyzer.fen_store_b)
+
+    result = {'positions': positions}
+    result['save_json_seconds'], _ = timed(analyzer.save_fen_store)
+    result['load_json_seconds'], _ = timed(AnalyzePGNs(path_save, checkpoint_every=None).load_fen_store)
+    result['save_binary_seconds'], _ = timed(analyzer.save_binary_store)
+    result['open_binary_seconds'], _ = timed(SearchOpenings('w', path_save).open_tree)
+    print('store   ', positions, 'positions   ', round(result['save_json_seconds'], 3), 's save json   ',
+          round(result['load_json_seconds'], 3), 's load json   ', round(result['save_binary_seconds'], 3),
+          's save binary   ', round(result['open_binary_seconds'], 4), 's open binary')
+    return result
+
+
+def bench_queries(path_save, pgn_path, num_queries=2000, seed=0):
+    # next_fen_finder latency on positions from the games themselves, with and without the edge index.
+    rng = random.Random(seed)
+    with open(pgn_path, 'r') as f:
+        games = [line.split()[:-1] for line in f if line.strip()]
+    queries = []
+    for _ in range(num_queries):
+        moves = rng.choice(games)
+        queries.append(moves[:rng.randrange(0, len(moves) + 1, 2)])  # White to move.
+
+    result = {}
+    for name, use_edges in [('edge_index', True), ('legal_moves', False)]:
+        search = SearchOpenings('w', path_save)
+        search.open_tree()
+        if not use_edges:
+            search.edges = None
+
+        latencies = []
+        for moves in queries:
+            search.reset_board()
+            search.push_pgn(' '.join(moves))
+            start = time.perf_counter()
+            search.next_fen_finder()
+            latencies.append(time.perf_counter() - start)
+
+        latencies.sort()
+        result[name] = {'p50_ms': latencies[len(latencies) // 2] * 1000,
+                        'p99_ms': latencies[len(latencies) * 99 // 100] * 1000,
+                        'queries_per_sec': len(latencies) / sum(latencies)}
+        print('next_fen_finder', name, '   ', round(result[name]['p50_ms'], 3), 'ms p50   ',
+              round(result[name]['p99_ms'], 3), 'ms p99')
+    return result
+
+
+def run_all(num_games=10000, seed=0, results_path='benchmark_results.json'):
+    # Everything on a freshly generated corpus, so two runs with the same arguments are comparable.
+    path_bench = tempfile.mkdtemp(prefix='opening_oracle_bench_')
+    try:
+        dump_path = os.path.join(path_bench, 'dump.pgn')
+        pgn_path = os.path.join(path_bench, 'all_pgns.pgn')
+        generate_seconds, _ = timed(generate_dump, dump_path, num_games, seed)
+        print("Generated", num_games, "games in", round(generate_seconds, 3), "s")
+
+        results = {'strip': bench_strip(dump_path), 'strip_user_pgn': bench_strip_user_pgn(dump_path),
+                   'keep_only_opening': bench_keep_only_opening(dump_path)}
+
+        downloader = DownloadPGNs(0, 4000, path_bench, 'blitz')
+        with open(dump_path, 'r') as f:
+            stripped = downloader.strip_user_pgn(f.read())
+        with open(pgn_path, 'w') as f:
+            f.write(stripped + '\n')
+
+        results['read_pgn'] = bench_read_pgn(pgn_path, num_games)
+        # Same again on a corpus where the whole kept opening (16 plies) mostly follows main lines,
+        # to show how the san cache does when openings overlap a lot.
+        shared_dump_path = os.path.join(path_bench, 'dump_shared_openings.pgn')
+        shared_pgn_path = os.path.join(path_bench, 'all_pgns_shared_openings.pgn')
+        generate_dump(shared_dump_path, num_games, seed, opening_plies=16, opening_skew=2.0)
+        with open(shared_dump_path, 'r') as f:
+            shared_stripped = downloader.strip_user_pgn(f.read())
+        with open(shared_pgn_path, 'w') as f:
+            f.write(shared_stripped + '\n')
+        results['read_pgn_shared_openings'] = bench_read_pgn(shared_pgn_path, num_games)
+        results['move_corpus_shared_openings'] = bench_move_corpus(shared_pgn_path)
+        results['move_corpus'] = bench_move_corpus(pgn_path)
+        analyze_seconds, _ = timed(AnalyzePGNs(path_bench, pgn_path, checkpoint_every=None).analyzer)
+        results['analyzer'] = {'seconds': analyze_seconds}
+        results['store_io'] = bench_store_io(path_bench)
+        results['queries'] = bench_queries(path_bench, pgn_path, seed=seed)
+    finally:
+        shutil.rmtree(path_bench)
+
+    report = {'date': datetime.datetime.now().isoformat(), 'num_games': num_games, 'seed': seed,
+              'python': platform.python_version(), 'chess': chess.__version__, 'results': results}
+    write_json_atomic(results_path, report, indent=4)
+    print("Results saved to", results_path)
+    return report
+
+
+if __name__ == "__main__":
+    # python benchmark.py all [num_games] [results.json]
+    # python benchmark.py generate dump.pgn [num_games] [seed] [opening_plies] [opening_skew]
+    # python benchmark.py read_pgn all_pgns.pgn [num_games]
+    # python benchmark.py strip monthly_dump.pgn [game_type]
+    if sys.argv[1] == 'all':
+        run_all(int(sys.argv[2]) if len(sys.argv) > 2 else 10000, 0,
+                sys.argv[3] if len(sys.argv) > 3 else 'benchmark_results.json')
+    elif sys.argv[1] == 'generate':
+        generate_dump(sys.argv[2], *[int(arg) for arg in sys.argv[3:6]] + [float(arg) for arg in sys.argv[6:]])
+    elif sys.argv[1] == 'strip':
+        bench_strip(*sys.argv[2:])
+    elif len(sys.argv) > 3:
+        bench_read_pgn(sys.argv[2], int(sys.argv[3]))
+    else:
+        bench_read_pgn(sys.argv[2])
@@ -0,0 +1,37 @@
+import json
+import os
+
+import benchmark
+import Opening_Oracle
+
+
+def load_store(path_save, color):
+    with open(os.path.join(path_save, 'wins_per_opening_' + color + '_all.json'), 'r') as f:
+        return json.load(f)
+
+
+def test_approx_counts_stay_within_error_bound(tmp_path):
+    dump_path = str(tmp_path / 'dump.pgn')
+    benchmark.generate_dump(dump_path, num_games=3000, seed=7)
+
+    # The exact counts, with the stripped games kept for the approximate run.
+    path_exact = str(tmp_path / 'exact')
+    os.makedirs(path_exact)
+    pgn_path = os.path.join(path_exact, 'all_pgns.pgn')
+    Opening_Oracle.ingest_dump(dump_path, 0, 4000, path_exact, keep_path=pgn_path)
+
+    # Narrow enough that a lot of positions share counters.
+    path_approx = str(tmp_path / 'approx')
+    os.makedirs(path_approx)
+    analyzer = Opening_Oracle.AnalyzePGNs(path_approx, pgn_path, checkpoint_every=None,
+                                          approx_threshold=3, sketch_width=1 << 10)
+    analyzer.analyzer()
+
+    for color, sketch in [('white', analyzer.sketch_w), ('black', analyzer.sketch_b)]:
+        exact = load_store(path_exact, color)
+        approx = load_store(path_approx, color)
+        assert sketch.error_bound() > 1  # Or the sketch isn't being tested.
+        for fen, (games, score) in exact.items():
+            if games >= 3:
+                assert fen in approx
+                assert 0 <= approx[fen][0] - games <= sketch.error_bound()
@@ -0,0 +1,51 @@
+import os
+
+import pytest
+
+import Opening_Oracle
+
+
+def open_dedup(path_games):
+    return Opening_Oracle.GameDeduplicator(os.path.join(path_games, 'Dedup'), 1000, deferred=True)
+
+
+def write_game(writer, dedup, game_key, moves):
+    new_keys = []
+    assert not dedup.seen(game_key, new_keys)
+    writer.write(moves, new_keys)
+
+
+def test_load_keeps_games_added_after_a_clean_run(tmp_path):
+    pgn_path = str(tmp_path / 'all_pgns.pgn')
+    dedup = open_dedup(str(tmp_path))
+    dedup.load(pgn_path)
+    writer = Opening_Oracle.PGNWriter(pgn_path, dedup=dedup)
+    writer.start()
+    write_game(writer, dedup, 'https://www.chess.com/game/live/1', 'e4 e5 1-0')
+    writer.close()
+
+    with open(pgn_path, 'a') as f:  # By hand, or from a run without dedup.
+        f.write('d4 d5 0-1\n')
+
+    dedup = open_dedup(str(tmp_path))
+    dedup.load(pgn_path)
+    assert dedup.seen('https://www.chess.com/game/live/1')
+    with open(pgn_path, 'r') as f:
+        assert f.read() == 'e4 e5 1-0\nd4 d5 0-1\n'
+
+
+def test_load_refuses_games_from_a_crashed_run(tmp_path):
+    pgn_path = str(tmp_path / 'all_pgns.pgn')
+    dedup = open_dedup(str(tmp_path))
+    dedup.load(pgn_path)
+    writer = Opening_Oracle.PGNWriter(pgn_path, dedup=dedup)
+    # Crashes after writing a game, before its key is saved.
+    writer.pgn_file.write('c4 c5 1-0\n')
+    writer.pgn_file.close()
+
+    with pytest.raises(ValueError):
+        open_dedup(str(tmp_path)).load(pgn_path)
+
+    open_dedup(str(tmp_path)).load(pgn_path, keep_unsaved=True)
+    with open(pgn_path, 'r') as f:
+        assert f.read() == 'c4 c5 1-0\n'
@@ -0,0 +1,55 @@
+import json
+import os
+
+import Opening_Oracle
+
+# database.lichess.org style: eval and clock comments, '?'/'!' annotations and the odd NAG.
+LICHESS_GAMES = [
+    '1. e4 { [%eval 0.17] [%clk 0:03:00] } 1... e5 { [%eval 0.2] [%clk 0:03:00] } 2. Nf3 Nc6 3. Bb5 a6 '
+    '4. Ba4 b5? { [%eval 1.1] } 5. Bb3?! Nf6 6. O-O Be7 7. Re1 d6 8. c3 O-O 9. h3 Na5 1-0',
+    '1. d4 d5 2. c4 e6 3. Nc3 Nf6 4. Bg5 Be7 5. e3 O-O 6. Nf3 h6 7. Bh4 b6 8. cxd5 Nxd5?? '
+    '9. Bxe7 Qxe7 10. Nxd5 exd5 0-1',
+    '1. e4 c5 2. Nf3 d6 $1 3. d4 cxd4 4. Nxd4 Nf6 5. Nc3 a6 6. Be3!? e5 7. Nb3 Be6 8. f3 Be7 1/2-1/2',
+]
+
+
+def write_dump(dump_path):
+    # Each game three times, so none of its positions get pruned.
+    with open(dump_path, 'w') as f:
+        for game_num, moves in enumerate(LICHESS_GAMES * 3):
+            f.write('[Event "Rated Blitz game"]\n[Site "https://lichess.org/abcd' + str(game_num) + '"]\n')
+            f.write('[Result "' + moves.split()[-1] + '"]\n[WhiteElo "1500"]\n[BlackElo "1550"]\n')
+            f.write('[TimeControl "180+0"]\n\n' + moves + '\n\n')
+
+
+def ingest(tmp_path, name, **analyzer_options):
+    path_save = str(tmp_path / name)
+    os.makedirs(path_save)
+    keep_path = os.path.join(path_save, 'all_pgns.pgn')
+    Opening_Oracle.ingest_dump(str(tmp_path / 'dump.pgn'), 1000, 2000, path_save, keep_path=keep_path,
+                               **analyzer_options)
+    with open(os.path.join(path_save, 'wins_per_opening_white_all.json'), 'r') as f:
+        stores = [json.load(f)]
+    with open(os.path.join(path_save, 'wins_per_opening_black_all.json'), 'r') as f:
+        stores.append(json.load(f))
+    with open(keep_path, 'r') as f:
+        return stores, f.read().splitlines()
+
+
+def test_annotations_are_stripped(tmp_path):
+    downloader = Opening_Oracle.DownloadPGNs(1000, 2000, str(tmp_path))
+    assert downloader.delete_extra_parts_pgn('1. e4 e5 2. Nf3 $1 Nc6?? 3. Bb5!? a6?! 4. Ba4! b5? 1-0') == \
+        '1. e4 e5 2. Nf3 Nc6 3. Bb5 a6 4. Ba4 b5 1-0'
+
+
+def test_annotated_games_count_fully(tmp_path):
+    write_dump(str(tmp_path / 'dump.pgn'))
+    fast, kept = ingest(tmp_path, 'fast')
+    slow, _ = ingest(tmp_path, 'slow', san_cache_size=0)
+
+    assert len(kept) == 9
+    assert not any(char in ''.join(kept) for char in '?!$')
+    # Every game has 8 moves for each side once it's cut down to the opening.
+    for store in fast:
+        assert sum(games for games, score in store.values()) == 9 * 8
+    assert fast == slow
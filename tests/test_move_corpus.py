@@ -0,0 +1,35 @@
+import os
+
+import Opening_Oracle
+
+GAMES = [
+    'e4 e5 Nf3 Nc6 Bb5 a6 Ba4 Nf6 O-O Be7 Re1 b5 Bb3 d6 c3 O-O 1-0',
+    'd4 d5 c4 e6 Nc3 Nf6 Bg5 Be7 e3 O-O Nf3 h6 Bh4 b6 cxd5 Nxd5 0-1',
+    'e4 c5 Nf3 d6 d4 cxd4 Nxd4 Nf6 Nc3 a6 Be3 e5 Nb3 Be6 f3 Be7 1/2-1/2',
+    # En passant and castling on both sides.
+    'e4 Nf6 e5 d5 exd6 Qxd6 d4 Bf5 Nc3 Nc6 Be3 O-O-O Qd2 e5 O-O-O exd4 0-1',
+    # Five white pieces can take on d5, so Qxd5 doesn't fit in a target square code.
+    'e4 a6 c4 a5 Nc3 Ra6 Nge2 Rb6 Nf4 h6 Qh5 d5 Qxd5 e6 Qd3 e5 1-0',
+]
+
+
+def analyze(path_save, pgn_path):
+    analyzer = Opening_Oracle.AnalyzePGNs(path_save, pgn_path, checkpoint_every=None)
+    for i, (offset, game) in enumerate(analyzer.iter_games()):
+        analyzer.read_line(i, game)
+    return analyzer.fen_store_w, analyzer.fen_store_b
+
+
+def test_move_corpus_counts_like_text(tmp_path):
+    path_save = str(tmp_path)
+    pgn_path = os.path.join(path_save, 'all_pgns.pgn')
+    corpus_path = os.path.join(path_save, 'all_games.mvs')
+    with open(pgn_path, 'w') as f:
+        f.write('\n'.join(GAMES * 2) + '\n')
+
+    assert Opening_Oracle.AnalyzePGNs(path_save, pgn_path).encode_move_corpus(corpus_path) == 10
+    records = Opening_Oracle.AnalyzePGNs(path_save, corpus_path).iter_move_records()
+    by_index = [Opening_Oracle.MOVE_RECORD.unpack(record)[4] for offset, record in records]
+    assert by_index == [0, 0, 0, 0, 1] * 2
+
+    assert analyze(path_save, corpus_path) == analyze(path_save, pgn_path)
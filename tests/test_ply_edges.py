@@ -0,0 +1,23 @@
+import json
+import os
+
+import Opening_Oracle
+
+
+def write_shard(path_plies, shard, edges):
+    with open(os.path.join(path_plies, 'edges_white_' + shard + '.json'), 'w') as f:
+        json.dump(edges, f)
+
+
+def test_find_stays_within_the_shards(tmp_path):
+    path_plies = str(tmp_path)
+    write_shard(path_plies, 'rest', {})
+    write_shard(path_plies, '00', {'start': [['e4', 'after_e4', 10, 6]]})
+    write_shard(path_plies, '02', {'after_e4_e5': [['Nf3', 'after_nf3', 5, 3]]})
+    edges = Opening_Oracle.PlyEdges(path_plies, 'edges_white')
+
+    # A fen from a server can have any move number.
+    for ply in [2, 40, 400, 4000]:
+        assert edges.find('after_e4_e5', ply) == [['Nf3', 'after_nf3', 5, 3]]
+    assert edges.find('somewhere_else', 400) is None
+    assert sorted(edges.shards) == [0, 1, 2]
@@ -0,0 +1,91 @@
+import Opening_Oracle
+
+MOVES = ['e4', 'e5', 'Nf3', 'Nc6', 'Bb5', 'a6', 'Ba4', 'Nf6', 'O-O', 'Be7', 'Re1', 'b5', 'Bb3', 'd6',
+         'c3', 'O-O', 'h3', 'Nb8', 'd4', 'Nbd7']
+
+
+def chess_com_moves(result='1-0'):
+    # Like chess.com's: a clock after every move and black's moves numbered with '...'.
+    pgn = []
+    for ply, san in enumerate(MOVES):
+        clock = '{[%clk 0:02:' + str(59 - ply).zfill(2) + '.9]}'
+        if ply % 2 == 0:
+            pgn.append(str(ply // 2 + 1) + '. ' + san + ' ' + clock)
+        else:
+            pgn.append(str(ply // 2 + 1) + '... ' + san + ' ' + clock)
+    return ' '.join(pgn) + ' ' + result
+
+
+def chess_com_game(time_control='180', white_elo='1500', black_elo='1520', variant=None, result='1-0'):
+    headers = ['[Event "Live Chess"]', '[Site "Chess.com"]', '[White "a"]', '[Black "b"]',
+               '[Result "' + result + '"]']
+    if variant is not None:
+        headers.append('[Variant "' + variant + '"]')
+    headers += ['[WhiteElo "' + white_elo + '"]', '[BlackElo "' + black_elo + '"]',
+                '[TimeControl "' + time_control + '"]', '[Termination "a won by resignation"]']
+    return headers + ['', chess_com_moves(result), '']
+
+
+def make_downloader(tmp_path):
+    downloader = Opening_Oracle.DownloadPGNs(1000, 2000, str(tmp_path))
+    downloader.dedup = None
+    return downloader
+
+
+def strip(downloader, lines):
+    stripper = Opening_Oracle.PGNStripper(downloader)
+    for line in lines:
+        stripper.feed(line)
+    return stripper.new_pgn
+
+
+def test_delete_extra_parts_removes_clocks_and_black_move_numbers(tmp_path):
+    downloader = make_downloader(tmp_path)
+    stripped = downloader.delete_extra_parts_pgn(chess_com_moves())
+    assert stripped == '1. e4 e5 2. Nf3 Nc6 3. Bb5 a6 4. Ba4 Nf6 5. O-O Be7 6. Re1 b5 7. Bb3 d6 ' \
+                       '8. c3 O-O 9. h3 Nb8 10. d4 Nbd7 1-0'
+
+
+def test_delete_extra_parts_unclosed_comment(tmp_path):
+    downloader = make_downloader(tmp_path)
+    # Everything after a comment that never closes is dropped.
+    assert downloader.delete_extra_parts_pgn('1. e4 {[%clk 0:02:59.9]} 1... e5 {[%clk 0:02:5') == '1. e4 e5'
+
+
+def test_delete_extra_parts_black_move_numbers(tmp_path):
+    downloader = make_downloader(tmp_path)
+    line = '1. e4 {[%clk 0:01:00]} 1... e5 ' + ' '.join(str(n) + '. Ke2 ' + str(n) + '... Ke7' for n in range(2, 12))
+    assert downloader.delete_extra_parts_pgn(line).split(' ')[-3:] == ['11.', 'Ke2', 'Ke7']
+    assert downloader.delete_extra_parts_pgn('1... e5 2. Nf3') == 'invalid'  # Starts with black's move.
+
+
+def test_feed_keeps_the_opening(tmp_path):
+    downloader = make_downloader(tmp_path)
+    assert strip(downloader, chess_com_game()) == \
+        ['e4 e5 Nf3 Nc6 Bb5 a6 Ba4 Nf6 O-O Be7 Re1 b5 Bb3 d6 c3 O-O 1-0']
+
+
+def test_feed_drops_daily_games(tmp_path):
+    downloader = make_downloader(tmp_path)
+    assert strip(downloader, chess_com_game(time_control='1/86400')) == []
+
+
+def test_feed_unknown_elo(tmp_path):
+    downloader = make_downloader(tmp_path)
+    assert strip(downloader, chess_com_game(white_elo='?', black_elo='?')) == []
+    # One player in range is enough.
+    assert len(strip(downloader, chess_com_game(white_elo='?'))) == 1
+
+
+def test_feed_drops_variants(tmp_path):
+    downloader = make_downloader(tmp_path)
+    lines = chess_com_game(variant='Chess960') + chess_com_game(result='0-1')
+    assert strip(downloader, lines) == ['e4 e5 Nf3 Nc6 Bb5 a6 Ba4 Nf6 O-O Be7 Re1 b5 Bb3 d6 c3 O-O 0-1']
+
+
+def test_feed_tags_buckets(tmp_path):
+    downloader = make_downloader(tmp_path)
+    downloader.bucket_size = 500
+    games = strip(downloader, chess_com_game() + chess_com_game(time_control='1/86400') +
+                  chess_com_game(white_elo='?', black_elo='1200'))
+    assert [game.split(' ')[0] for game in games] == ['@blitz_1500']